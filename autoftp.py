@@ -7,10 +7,36 @@ import os
 import sys
 import time
 import ftplib
+import threading
+import hashlib
+import json
+import io
+import random
+import socket
+import queue
+import struct
+import zlib
+import math
+import difflib
+import itertools
+import collections
+import functools
+import heapq
+import re
+import shutil
+import contextlib
+import tempfile
 from getopt import GetoptError, gnu_getopt as getopt
 from watchdog.observers import Observer
-from watchdog.events import PatternMatchingEventHandler
-from pathlib import Path
+from watchdog.events import FileSystemEventHandler
+try: # Linux: inotify, whose recursive watches can be pruned
+    from watchdog.observers.api import BaseObserver
+    from watchdog.observers.inotify import InotifyEmitter
+    from watchdog.observers.inotify_buffer import InotifyBuffer
+    from watchdog.observers.inotify_c import Inotify
+    from watchdog.utils.delayed_queue import DelayedQueue
+except ImportError:
+    Inotify = None
 import subprocess
 
 import colorama
@@ -19,21 +45,198 @@ _BRI = colorama.Style.BRIGHT
 _RST = colorama.Style.RESET_ALL
 _GREEN = colorama.Fore.GREEN
 __VERSION__='v0.2.1'
+_DEFLATE_WBITS = 10 # 1KB window: small enough for the device to inflate
+_MIN_COMPRESS = 256 # don't bother compressing smaller files
+_MIN_RATE_SIZE = 8192 # transfers large enough to measure the data rate
+_MAX_BATCH = 32 # most files to send in one batch
+_KEEPALIVE = 30 # seconds idle before checking a session with NOOP
+_VERIFY_TRIES = 3 # most times to send a file failing --verify
+_VERIFY_DIR = 8 # fewest files sent to a directory to --verify by hashing it whole
+_TIMEOUT = 10 # seconds to wait on a connection attempt or reply
+_BACKOFF_MIN = 0.5 # seconds before retrying a connection, doubling on each failure
+_BACKOFF_MAX = 10 # most seconds between connection attempts
+_DNS_TTL = 300 # seconds to use a resolved address before refreshing it
+_ATTEMPT_DELAY = 0.25 # seconds before also trying the next address
+_MAX_WATCHES = 64 # most watches (each an inotify instance, 128 per user by default)
+_SAVE_DELAY = 1 # seconds to gather manifest updates before writing them
+_STAT_DIR_FD = os.stat in os.supports_dir_fd
 
-def path_matches(path,patterns, key = None):
-    if patterns:
-        ppath = Path(path) # *destination* must also match
-        try:
-            match = next(x for x in patterns if ppath.match(x[key] if key else x))
-        except StopIteration:
-            return None
+def glob_regex(part):
+    # Regular expression for one component of a glob pattern, as fnmatch
+    # would match it, with wildcards never crossing a '/'
+    out, i, n = [], 0, len(part)
+    while i < n:
+        c = part[i]
+        i += 1
+        if c == '*':
+            if not out or out[-1] != '[^/]*':
+                out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i + (part[i:i+1] == '!')
+            j += part[j:j+1] == ']'
+            j = part.find(']', j)
+            if j < 0:
+                out.append('\\[')
+            else:
+                chars = part[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if chars[0] == '!':
+                    chars = '^/' + chars[1:]
+                elif chars[0] == '^':
+                    chars = '\\' + chars
+                out.append(f'[{chars}]')
         else:
-            return match
+            out.append(re.escape(c))
+    return ''.join(out)
+
+def map_output(path, pattern, output):
+    # Path of the output of processing path, which matched pattern, named by
+    # output (e.g. '*.mpy' for '*.py'): the wildcards of output are filled
+    # in turn with the text matched by those of pattern's last component,
+    # and the output is placed beside path
+    name = re.split(r'[\\/]' if os.sep == '\\' else '/', pattern)[-1]
+    regex = ''.join('([^/]*)' if p == '*' else '([^/])' if p == '?' else glob_regex(p)
+                    for p in re.split(r'([*?])', name))
+    flags = re.DOTALL | (re.IGNORECASE if os.name == 'nt' else 0)
+    match = re.fullmatch(regex, os.path.basename(path), flags)
+    groups = iter(match.groups() if match else ())
+    return os.path.join(os.path.dirname(path),
+                        re.sub(r'[*?]', lambda m: next(groups, ''), output))
+
+class Rules:
+    """The include, exclude, process, up-delete and remote-match patterns,
+    compiled once.  Patterns match as with PurePath.match: against the
+    trailing components of a path, so each set of patterns is compiled to
+    one regular expression per number of components, matched against just
+    that many of a path's trailing components.  Exclude patterns ending in
+    '/' match directories, excluding everything below them.  classify(path)
+    returns all of a path's matches at once, and is memoized."""
+    Match = collections.namedtuple("Match", ("include", "exclude", "process",
+                                             "up_delete", "remote_match"))
+
+    def __init__(self, config, exclude):
+        self.process = config["process"]
+        dirs = [p for p in exclude if p.endswith(('/', os.sep))]
+        self.compiled = [self.compile(patterns) for patterns in
+                         (config["include"], [p for p in exclude if p not in dirs],
+                          [x['pattern'] for x in self.process],
+                          config["up-delete"], config["remote-match"])]
+        self.dirs = self.compile(dirs)
+        self.classify = functools.lru_cache(maxsize = 2**16)(self.classify)
+        self.excluded_dir = functools.lru_cache(maxsize = 2**16)(self.excluded_dir)
+
+    @staticmethod
+    def compile(patterns):
+        # [(components, regex)], with a named group per pattern, in order
+        alts = {}
+        for i, pattern in enumerate(patterns):
+            parts = [p for p in re.split(r'[\\/]' if os.sep == '\\' else '/', pattern)
+                     if p and p != '.']
+            if parts and not pattern.startswith(('/', os.sep)): # (paths are relative)
+                alts.setdefault(len(parts), []).append(
+                    f"(?P<p{i}>{'/'.join(map(glob_regex, parts))})")
+        flags = re.DOTALL | (re.IGNORECASE if os.name == 'nt' else 0)
+        return [(n, re.compile('|'.join(a), flags)) for n, a in sorted(alts.items())]
+
+    @staticmethod
+    def first(compiled, parts):
+        # Index of the first pattern matching path components parts, if any
+        first = None
+        for n, regex in compiled:
+            if n > len(parts): break
+            match = regex.fullmatch('/'.join(parts[-n:]))
+            if match:
+                i = int(match.lastgroup[1:])
+                first = i if first is None else min(first, i)
+        return first
+
+    @staticmethod
+    def parts(path):
+        return [p for p in path.replace(os.sep, '/').split('/') if p and p != '.']
+
+    def excluded_dir(self, path):
+        # Is directory path, or one of its parents, excluded?
+        parts = self.parts(path)
+        return bool(parts) and (self.first(self.dirs, parts) is not None or
+                                self.excluded_dir('/'.join(parts[:-1])))
+
+    def classify(self, path):
+        parts = self.parts(path)
+        found = [self.first(compiled, parts) for compiled in self.compiled]
+        excluded = found[1] is not None or (bool(self.dirs) and
+                                            self.excluded_dir('/'.join(parts[:-1])))
+        return self.Match(found[0] is not None, excluded,
+                          None if found[2] is None else self.process[found[2]],
+                          found[3] is not None, found[4] is not None)
+
+_log_buffer = threading.local()
+_log_lock = threading.Lock()
+log_buffered = False # Set when several threads log concurrently
+
+def _print(text, file = None, end = '\n', flush = False):
+    # With several threads logging, hold partial lines until complete
+    if not log_buffered:
+        print(text, file = file, end = end, flush = flush)
+        return
+    line = getattr(_log_buffer, 'line', '') + text + end
+    if line.endswith('\n'):
+        _log_buffer.line = ''
+        with _log_lock:
+            print(line, file = file, end = '', flush = True)
+    else:
+        _log_buffer.line = line
+
+def make_patch(old, new):
+    """Encode new as a patch against old for the uftpd XPAT command: the
+    expected size and sha256 digest of old, followed by copy-range ('C',
+    offset, length) and insert ('I', length, bytes) ops.  Lines are
+    matched, as for source."""
+    a, b = old.splitlines(keepends = True), new.splitlines(keepends = True)
+    offsets = list(itertools.accumulate(map(len, a), initial = 0))
+    ops = [struct.pack(">I", len(old)), hashlib.sha256(old).digest()]
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk = False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(struct.pack(">cII", b'C', offsets[i1], offsets[i2] - offsets[i1]))
+        elif j2 > j1:
+            insert = b''.join(b[j1:j2])
+            ops.append(struct.pack(">cI", b'I', len(insert)) + insert)
+    return b''.join(ops)
+
+def parents(subdir):
+    # Each leading component of subdir: a, a/b, a/b/c
+    cur = ''
+    for dr in subdir.split(os.sep):
+        if dr in ('', '.'): continue
+        cur = os.path.join(cur,dr)
+        yield cur
 
-def log(msg = None, error = False, dry_run = False, prefix = None, **kwds):
+def pack_files(items):
+    # Records of (path length, path, data length, data), as for uftpd XBAT
+    return b''.join(struct.pack(">H", len(rpath)) + rpath + struct.pack(">I", len(data)) + data
+                    for rpath, data in ((path.replace(os.sep, '/').encode(), data)
+                                        for path, data in items))
+
+def unpack_files(archive):
+    pos = 0
+    while pos < len(archive):
+        length, = struct.unpack_from(">H", archive, pos)
+        path = archive[pos+2:pos+2+length].decode().replace('/', os.sep)
+        pos += 2 + length
+        length, = struct.unpack_from(">I", archive, pos)
+        yield path, archive[pos+4:pos+4+length]
+        pos += 4 + length
+
+def deflate(data):
+    z = zlib.compressobj(9, zlib.DEFLATED, _DEFLATE_WBITS)
+    return z.compress(data) + z.flush()
+
+def log(msg = None, error = False, dry_run = False, prefix = None, end = '\n', flush = False):
     file = sys.stderr if error else None
     if prefix:
-        print(prefix, file = file, end = '', flush = True, **kwds)
+        _print(prefix, file = file, end = '', flush = True)
     if msg:
         if error:
             col = colorama.Fore.RED
@@ -41,184 +244,1629 @@ def log(msg = None, error = False, dry_run = False, prefix = None, **kwds):
             col = colorama.Fore.BLUE
         else:
             col = colorama.Fore.GREEN
-        print(col + msg + colorama.Fore.RESET,file=file, **kwds)
+        _print(col + msg + colorama.Fore.RESET, file = file, end = end, flush = flush)
     if not prefix and not msg:
-        print("")
+        _print("")
+
+class Manifest:
+    """Content hash and size of the files last uploaded to a host, keyed by
+    remote path, persisted across runs in a local cache file.  Also records
+    the content of files last run through a processing script, and files
+    still queued for the host while it was down.  Manifests for several
+    hosts can share one file, by passing another as shared.  Updates are
+    written out together, _SAVE_DELAY after the first, or on flush()."""
+    def __init__(self, host, file = ".autoftp-cache", shared = None):
+        if shared:
+            self.file, self.lock, self.hosts = shared.file, shared.lock, shared.hosts
+            self.root = shared.root # owner of the file's pending write
+        else:
+            self.file = file
+            self.lock = threading.Lock()
+            self.root = self
+            self.timer = None
+            try:
+                with open(file, "r") as f:
+                    self.hosts = json.load(f)
+            except (OSError, ValueError):
+                self.hosts = {}
+        tables = self.hosts.setdefault(host, {})
+        self.entries = tables.setdefault("uploaded", {})
+        self.processed = tables.setdefault("processed", {})
+        self.pending = tables.setdefault("pending", [])
+
+    def unchanged(self, path, digest, size, table = None):
+        return (self.entries if table is None else table).get(path) == [digest, size]
+
+    def update(self, path, digest, size, table = None):
+        with self.lock:
+            (self.entries if table is None else table)[path] = [digest, size]
+            self.save()
+
+    def forget(self, path):
+        with self.lock:
+            if self.entries.pop(path, None):
+                self.save()
+
+    def set_pending(self, paths):
+        # Record the paths queued for upload, to send should we restart
+        with self.lock:
+            if paths != self.pending:
+                self.pending[:] = paths
+                self.save()
+
+    def save(self):
+        # Schedule a write of all updates (called holding the lock)
+        root = self.root
+        if not root.timer:
+            root.timer = threading.Timer(_SAVE_DELAY, root.flush)
+            root.timer.daemon = True
+            root.timer.start()
+
+    def flush(self):
+        # Write any pending updates now
+        root = self.root
+        with self.lock:
+            if not root.timer: return
+            root.timer.cancel()
+            root.timer = None
+            tmp = self.file + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.hosts, f)
+            os.replace(tmp, self.file)
+
+class Tracer:
+    """Durations of the stages of handling files (queueing, scripts,
+    connecting, transfers...), for a summary on exit and, optionally, as
+    JSON lines written to a file."""
+    def __init__(self):
+        self.spans = {} # stage -> durations
+        self.lock = threading.Lock()
+        self.file = None
+
+    def open(self, file):
+        self.file = open(file, "a", buffering = 1)
+
+    def record(self, stage, t0, **info):
+        # Record stage as lasting from perf_counter time t0 until now
+        dur = time.perf_counter() - t0
+        with self.lock:
+            self.spans.setdefault(stage, []).append(dur)
+            if self.file:
+                self.file.write(json.dumps(dict(t = round(time.time(), 4), stage = stage,
+                                                ms = round(dur * 1000, 3), **info)) + "\n")
+
+    @contextlib.contextmanager
+    def span(self, stage, **info):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, t0, **info)
+
+    def summary(self):
+        # Percentiles and a histogram (by decade) of each stage's durations
+        if not self.spans: return
+        log(prefix = f"== Timings (ms)   {'n':>6} {'p50':>8} {'p95':>8} {'max':>8}"
+            f"   <1ms  <10ms <100ms    <1s    >1s\n")
+        for stage, durs in self.spans.items():
+            durs = sorted(durs)
+            pct = lambda q: durs[min(len(durs) - 1, int(q * len(durs)))] * 1000
+            hist = [0] * 5
+            for d in durs:
+                hist[min(4, max(0, int(math.floor(math.log10(max(d, 1e-9)))) + 4))] += 1
+            log(prefix = f"   {stage:<14}{len(durs):>6} {pct(.5):>8.1f} {pct(.95):>8.1f} "
+                f"{durs[-1] * 1000:>8.1f} " + ''.join(f"{n:>7}" for n in hist) + "\n")
+
+tracer = Tracer()
 
 def cur_time():
     l = time.localtime()
     return f"{_BRI}{l.tm_hour:02}:{l.tm_min:02}:{l.tm_sec:02}{_RST}"
         
-class FTPWatcher(PatternMatchingEventHandler):
-    def __init__(self, config, **kwargs):
-        patterns = config["include"] or []
-        if config["process"]:
-            patterns.extend(x['pattern'] for x in config["process"])
-        super().__init__(patterns = patterns, ignore_patterns = config["exclude"], **kwargs)
-        self.host = config["host"]
-        self.config = config
-        self.ftp_start()
+class OutputCache:
+    """Size-bounded store of processing script outputs, keyed by the script
+    (and the output it is mapped to, if any), the input file's path and its
+    content.  Least recently used entries are
+    evicted first."""
+    def __init__(self, limit, dir = ".autoftp-cache.d"):
+        self.dir = dir
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
 
-    def ftp_start(self, max_tries = 3):
-        if hasattr(self,'ftp') and self.ftp:
-            self.ftp.close()
-            log(prefix = "==  Reconnecting FTP... \n")
-        tries = 0
-        while tries < max_tries:
+    def key(self, script, path, data, output = None, stdout = False):
+        exe = shutil.which(script) or script
+        try:
+            st = os.stat(exe)
+        except OSError:
+            ident = exe
+        else: # a rebuilt script invalidates its outputs
+            ident = f"{exe}:{st.st_size}:{st.st_mtime_ns}"
+        h = hashlib.sha256(f"{ident}\0{output}\0{stdout:d}\0{path}\0".encode())
+        h.update(data)
+        return h.hexdigest()
+
+    def get(self, key):
+        file = os.path.join(self.dir, key)
+        try:
+            with open(file, "rb") as f:
+                archive = f.read()
+            os.utime(file) # recently used
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return list(unpack_files(archive))
+
+    def put(self, key, outputs):
+        os.makedirs(self.dir, exist_ok = True)
+        file = os.path.join(self.dir, key)
+        with open(file + ".tmp", "wb") as f:
+            f.write(pack_files(outputs))
+        os.replace(file + ".tmp", file)
+        with self.lock:
+            entries = sorted((e.stat().st_mtime, e.stat().st_size, e.path)
+                             for e in os.scandir(self.dir))
+            total = sum(size for mtime, size, path in entries)
+            for mtime, size, path in entries:
+                if total <= self.limit: break
+                os.remove(path)
+                total -= size
+
+    def counts(self):
+        return f"({self.hits} cached, {self.misses} run)"
+
+class Superseded(Exception):
+    """A newer version of a file arrived while it was being stored."""
+
+class AbortableStream(io.BytesIO):
+    """Data to store, which ends early once aborted is set."""
+    def __init__(self, data):
+        super().__init__(data)
+        self.aborted = threading.Event()
+
+    def read(self, size = -1):
+        return b'' if self.aborted.is_set() else super().read(size)
+
+class SettleQueue:
+    """Paths waiting for their events to settle before being handled.
+    Repeated puts of a path coalesce into one.  Paths claimed by a worker
+    are in flight until done, and are not claimed again meanwhile.  If
+    stage is given, the time from each path's last event to its claim is
+    traced under that name.  Settled paths are claimed in order of
+    priority(path, time of event), lowest first, if given, else in order
+    of arrival.  Each path's priority is computed just once, as it
+    settles (when e.g. its size is final), and settled paths kept in a heap."""
+    def __init__(self, settle, stage = None, priority = None, **info):
+        self.settle = settle
+        self.stage = stage
+        self.priority = priority
+        self.info = info
+        self.pending = {} # path -> time of most recent event
+        self.settling = collections.deque() # (time, arrival, path), by time
+        self.ready = [] # heap of settled (priority, time, path)
+        self.seq = itertools.count() # arrival order, without priority
+        self.inflight = {} # path -> when it settled
+        self.cond = threading.Condition()
+
+    def put(self, path):
+        # Returns whether path is currently in flight
+        with self.cond:
+            t = self.pending[path] = time.perf_counter() # earlier entries now stale
+            self.settling.append((t, next(self.seq), path))
+            self.cond.notify()
+            return path in self.inflight
+
+    def claim(self, limit = 1, timeout = None):
+        # Block until pending paths have settled, and claim up to limit of
+        # them.  Returns an empty list if none settle within timeout.
+        end = timeout and time.perf_counter() + timeout
+        with self.cond:
+            while True:
+                now = time.perf_counter()
+                while self.settling and now - self.settling[0][0] >= self.settle:
+                    t, key, path = self.settling.popleft()
+                    if self.pending.get(path) == t:
+                        if self.priority:
+                            key = self.priority(path, t)
+                        heapq.heappush(self.ready, (key, t, path))
+                paths, busy = [], []
+                while self.ready and len(paths) < limit:
+                    key, t, path = entry = heapq.heappop(self.ready)
+                    if self.pending.get(path) != t: continue # stale
+                    if path in self.inflight: # claimable once done
+                        busy.append(entry)
+                        continue
+                    if self.stage:
+                        tracer.record(self.stage, t, path = path, **self.info)
+                    del self.pending[path]
+                    self.inflight[path] = t + self.settle
+                    paths.append(path)
+                for entry in busy:
+                    heapq.heappush(self.ready, entry)
+                if paths: return paths
+                while self.settling and self.pending.get(self.settling[0][2]) != self.settling[0][0]:
+                    self.settling.popleft() # stale
+                wait = self.settle - (now - self.settling[0][0]) if self.settling else None
+                if end:
+                    if now >= end: return []
+                    wait = min(wait or end - now, end - now)
+                self.cond.wait(wait)
+
+    def done(self, paths):
+        with self.cond:
+            for path in paths:
+                self.inflight.pop(path, None)
+            self.cond.notify_all()
+
+    def paths(self):
+        # All paths queued or in flight
+        with self.cond:
+            return sorted(self.inflight.keys() | self.pending.keys())
+
+    def settled(self, path):
+        # When claimed path settled
+        with self.cond:
+            return self.inflight.get(path)
+
+    def idle(self):
+        # Nothing pending or in flight?
+        with self.cond:
+            return not self.pending and not self.inflight
+
+class AddressCache:
+    """Resolved addresses of hosts, so (re)connecting to a board needn't
+    wait seconds on (m)DNS.  Hosts are resolved when first used, and
+    again in the background once their addresses are _DNS_TTL old, or all
+    fail to connect.  Connections try the addresses happy eyeballs style
+    (RFC 8305): each after the last fails, or _ATTEMPT_DELAY passes."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {} # (host, port) -> [addresses, time resolved]
+        self.refreshing = set()
+
+    def lookup(self, host, port):
+        with self.lock:
+            entry = self.entries.get((host, port))
+        if not entry:
+            return self.resolve(host, port)
+        if time.monotonic() - entry[1] > _DNS_TTL:
+            self.refresh(host, port)
+        return entry[0]
+
+    def resolve(self, host, port):
+        # Addresses of host, alternating address families
+        t0 = time.perf_counter()
+        infos = socket.getaddrinfo(host, port, type = socket.SOCK_STREAM)
+        tracer.record("resolve", t0, host = host)
+        families = [[(family, addr) for family, _, _, _, addr in infos if family == f]
+                    for f in dict.fromkeys(info[0] for info in infos)]
+        addresses = [a for group in itertools.zip_longest(*families) for a in group if a]
+        with self.lock:
+            old = self.entries.get((host, port))
+            self.entries[(host, port)] = [addresses, time.monotonic()]
+        if old and old[0] != addresses:
+            log(prefix = f"== {cur_time()} {host} ",
+                msg = f"now at {', '.join(a[1][0] for a in addresses)}")
+        return addresses
+
+    def refresh(self, host, port):
+        # Resolve host again, in the background
+        with self.lock:
+            if (host, port) in self.refreshing: return
+            self.refreshing.add((host, port))
+        def resolve():
             try:
-                self.ftp = ftplib.FTP(self.host)
-            except ConnectionError as e:
-                exc = e
-                tries += 1
-                time.sleep(1)
-            else:
+                self.resolve(host, port)
+            except OSError: # keep the addresses we had
+                pass
+            finally:
+                with self.lock:
+                    self.refreshing.discard((host, port))
+        threading.Thread(target = resolve, daemon = True).start()
+
+    def connect(self, host, port, timeout):
+        # A socket connected to host, by whichever address answers first
+        results = queue.Queue()
+        won = [] # the winning socket: later ones are closed
+        lock = threading.Lock()
+        def attempt(family, addr):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(addr)
+            except OSError as e:
+                sock.close()
+                results.put(e)
+                return
+            with lock:
+                if won:
+                    sock.close()
+                    return
+                won.append(sock)
+            results.put(sock)
+
+        todo = list(self.lookup(host, port))
+        end = time.monotonic() + timeout
+        running, error = 0, None
+        while todo or running:
+            if todo:
+                threading.Thread(target = attempt, args = todo.pop(0), daemon = True).start()
+                running += 1
+            wait = max(0, end - time.monotonic())
+            try:
+                result = results.get(timeout = min(wait, _ATTEMPT_DELAY) if todo else wait)
+            except queue.Empty:
+                if todo: continue # start the next attempt alongside
                 break
-                
-        if tries == max_tries:
-            log(prefix = "==  ",
-                msg = f"Could not connect to {self.host}: \n\t{repr(exc)}", error = True)
-            exit();
-
-        self.ftp.login()
-        if self.is_ok():
+            running -= 1
+            if isinstance(result, socket.socket):
+                return result
+            error = result
+        with lock:
+            if won: # connected just as we gave up
+                return won[0]
+            won.append(None)
+        self.refresh(host, port) # has it moved?
+        raise error or TimeoutError(f"timed out connecting to {host}")
+
+addresses = AddressCache()
+
+class CachedFTP(ftplib.FTP):
+    """An FTP connection made to an address from the AddressCache."""
+    def connect(self, host = '', port = 0, timeout = -999, source_address = None):
+        if host:
+            self.host = host
+        if port > 0:
+            self.port = port
+        if timeout != -999:
+            self.timeout = timeout
+        self.sock = addresses.connect(self.host, self.port, self.timeout)
+        self.af = self.sock.family
+        self.file = self.sock.makefile('r', encoding = self.encoding)
+        self.welcome = self.getresp()
+        return self.welcome
+
+class FTPSession:
+    """A logged-in FTP connection to host, with its cache of known remote
+    directories.  Once uploads start, a session is used only by its own
+    worker thread, which holds lock while using it."""
+    def __init__(self, host, config, name = ''):
+        self.host = host
+        self.config = config
+        self.name = name
+        self.ftp = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        # Connect and log in, once.  Raises ConnectionError on failure.
+        t0 = time.perf_counter()
+        self.close()
+        try:
+            self.ftp = CachedFTP(self.host, timeout = _TIMEOUT)
+            self.ftp.login()
             pwd = self.ftp.pwd()
-            log(prefix = "==  FTP server connected: ", msg = f"{self.host} (pwd: {pwd})")
-        else:
-            raise ConnectionError
+            self.get_features()
+            self.scan_dirs()
+        except (OSError, EOFError, ftplib.Error) as e: # refused, timed out, unknown host...
+            self.close()
+            raise ConnectionError(e) from e
+        ip = self.ftp.sock.getpeername()[0]
+        log(prefix = f"==  FTP server connected{self.name}: ",
+            msg = f"{self.host}{f' [{ip}]' if ip != self.host else ''} "
+            f"(pwd: {pwd}, {len(self.rdirs)} known directories)")
+        tracer.record("connect", t0, host = self.host)
         if self.config["debug"]:
             self.ftp.set_debuglevel(2)
-        
+
+    def close(self):
+        # Drop the connection, e.g. after it failed
+        if self.ftp:
+            try:
+                self.ftp.close()
+            except OSError:
+                pass
+            self.ftp = None
+
     def is_ok(self):
+        if not self.ftp: return False
         try:
             self.ftp.voidcmd("NOOP")
-        except (ftplib.error_reply, ftplib.error_perm, TimeoutError, EOFError, ConnectionError):
+        except (ftplib.error_reply, ftplib.error_perm, ftplib.error_temp,
+                EOFError, OSError): # e.g. host unreachable
             return False
         else:
             return True
 
-    def mkdirs(self, subdir):
-        cur = ''
-        for dr in subdir.split(os.sep):
-            if dr == '.': continue
-            cur = os.path.join(cur,dr)
+    def quit(self):
+        # Wait (briefly) for any transfer in progress to finish
+        if self.ftp and self.lock.acquire(timeout = 5):
             try:
-                self.ftp.voidcmd("SIZE " + cur) # Exists?
-            except:
-                self.ftp.mkd(cur)
+                self.ftp.quit()
+            except (OSError, EOFError, ftplib.Error): # already gone
+                pass
+            finally:
+                self.lock.release()
 
-    def on_moved(self, event):
-        if path_matches(event.dest_path, self.config["include"]):
-            self.handle(event.dest_path)
-        
-    def on_created(self, event):
-        self.handle(event.src_path)
+    def get_features(self):
+        # Extension commands the server advertises (e.g. uftpd's XPAT)
+        try:
+            resp = self.ftp.sendcmd("FEAT")
+        except (ftplib.error_perm, ftplib.error_temp, ftplib.error_reply):
+            self.features = set()
+        else:
+            self.features = {line.split()[0].upper() for line in resp.splitlines()[1:-1]
+                             if line.strip()}
 
-    def on_modified(self, event):
-        self.handle(event.src_path)
-        
-    def handle(self,path):
-        if not os.path.isfile(path): return # Ignore phantom modified on delete
-        path = os.path.relpath(path)
-        
-        log(prefix=f">> {cur_time()} Processing {_BRI}{path}{_RST}...")
-        ppath = Path(path)
+    def listdir(self, rdir):
+        # List remote directory rdir, yielding (name, is_dir, size)
+        lines = []
+        self.ftp.retrlines("LIST " + rdir if rdir else "LIST", lines.append)
+        for line in lines:
+            fields = line.split(None, 8)
+            if len(fields) < 6 or fields[-1] in ('.','..'): continue
+            try:
+                size = int(fields[4])
+            except ValueError:
+                size = None
+            yield fields[-1], line.startswith('d'), size
+
+    def hashes(self, rdir = ''):
+        # Size and sha256 digest of every file in remote directory rdir and
+        # below, in one round trip (XHSH, see example/lib/uftpd.py)
+        lines = []
+        with tracer.span("hash", host = self.host, path = rdir):
+            self.ftp.retrlines("XHSH " + rdir if rdir else "XHSH", lines.append)
+        remote = {}
+        for line in lines:
+            digest, size, name = line.split(' ', 2)
+            remote[os.path.join(rdir, name)] = int(size), digest
+        return remote
+
+    def hash(self, path):
+        # Size and sha256 digest of remote file path, or None if it's missing
+        try:
+            return next(iter(self.hashes(path).values()), None)
+        except ftplib.error_perm:
+            return None
 
+    def scan_dirs(self):
+        # Cache the remote directories which mirror local ones, listing each
+        # once.  Valid for this session only: rescanned on every (re)connect.
+        self.rdirs = set()
+        todo = ['']
+        while todo:
+            rdir = todo.pop()
+            for name, is_dir, size in self.listdir(rdir):
+                cur = os.path.join(rdir, name)
+                if is_dir and os.path.isdir(cur):
+                    self.rdirs.add(cur)
+                    todo.append(cur)
+
+    def mkdirs(self, subdir):
+        # Create any missing components of subdir not known to exist
+        for cur in parents(subdir):
+            if cur not in self.rdirs:
+                try:
+                    with tracer.span("mkdir", host = self.host, path = cur):
+                        self.ftp.mkd(cur)
+                except ftplib.error_perm: # already there, or STOR will tell
+                    pass
+                else:
+                    log(f" [created {cur}/]", end = '', flush = True)
+                self.rdirs.add(cur)
+
+class Uploader:
+    """Sends files queued by an FTPWatcher to one host, over its own
+    sessions, with its own manifest, retries and remote commands, so a slow
+    or rebooting host does not hold up others."""
+    def __init__(self, watcher, host, manifest = None):
+        self.watcher = watcher
+        self.host = host
+        self.config = config = watcher.config
+        self.manifest = Manifest(host, shared = manifest)
+        self.tag = f" [{host}]" if len(config["host"]) > 1 else ''
+        self.lock = threading.Lock()
+        self.sent = self.skipped = 0
+        self.latencies = [] # seconds from settled to sent, per file
+        self.settled = {} # path -> when its oldest unsent change settled
+        self.bases = {} # path -> content last sent, for delta uploads
+        self.raw_bytes = self.wire_bytes = 0 # for compressed uploads
+        self.time_saved = 0.
+        self.rate = None # best transfer rate seen, bytes/s
+        self.commands = {} # %%f name -> path, for the remote command when idle
+        self.unverified = {} # path -> digest sent, for --verify when idle
+        self.failures = collections.Counter() # path -> failed verifications
+        self.uploads = SettleQueue(config["settle"], "queue", self.priority, host = host)
+        for path in self.manifest.pending: # left queued by the last run
+            self.uploads.put(path)
+        self.storing = {} # path -> AbortableStream being stored
+        self.partial = {} # path -> (digest, bytes sent) of content cut off mid-store
+        n = max(1, config["connections"])
+        label = host + ' ' if self.tag else ''
+        self.sessions = [FTPSession(host, config, f" [{label}{i+1}/{n}]" if n > 1 else self.tag)
+                         for i in range(n)]
+
+    def start(self):
+        if self.manifest.pending:
+            log(prefix = f"== {self.host}: ",
+                msg = f"{len(self.manifest.pending)} files still queued from the last run")
+        for i, session in enumerate(self.sessions):
+            threading.Thread(target = self.run, daemon = True,
+                             args = (session, i == 0 and self.config["sync"])).start()
+
+    def sync(self, session):
+        # Reconcile the local tree with the remote before watching, queueing
+        # files which differ.  The server's hashes of its whole tree, or
+        # else one LIST per directory, provide remote content (or sizes).
+        log(prefix = f"== {cur_time()} Syncing with {self.host}...")
         t0 = time.perf_counter()
+        local = []
+        for root, dirs, files in os.walk('.'):
+            dirs[:] = [d for d in dirs
+                       if not self.watcher.rules.excluded_dir(os.path.join(root, d))]
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name))
+                if self.watcher.wanted(path):
+                    local.append(path)
+        if "XHSH" in session.features:
+            remote = session.hashes()
+        else:
+            remote = {}
+            for rdir in {os.path.dirname(path) for path in local}:
+                if rdir and rdir not in session.rdirs: continue # all missing
+                for name, is_dir, size in session.listdir(rdir):
+                    if not is_dir:
+                        remote[os.path.join(rdir, name)] = size, None
+        queued = 0
+        for path in local:
+            if self.differs(path, *remote.get(path, (None, None))):
+                if self.watcher.rules.classify(path).process:
+                    self.watcher.enqueue(path) # outputs will go to every host
+                else:
+                    self.uploads.put(path)
+                queued += 1
+        log(f" {len(local)} files checked in {_BRI}{time.perf_counter()-t0:.2}s{_RST}, "
+            f"{queued} to send")
+
+    def differs(self, path, rsize, rdigest = None):
+        # Does local path differ from the remote file of size rsize (and
+        # sha256 rdigest, if known)?
+        data, digest = self.watcher.read(path, self.host)
+        if self.watcher.rules.classify(path).process:
+            return not self.manifest.unchanged(path, digest, len(data),
+                                               self.manifest.processed)
+        if rdigest: # the remote content is known
+            if rdigest != digest:
+                self.manifest.forget(path)
+                return True
+            self.manifest.update(path, digest, len(data))
+            return False
+        entry = self.manifest.entries.get(path)
+        if rsize != len(data) or (entry and entry[1] != rsize):
+            self.manifest.forget(path) # remote no longer holds what we sent
+            return True
+        return bool(entry) and entry[0] != digest
+
+    def run(self, session, sync = False):
+        # Upload worker, the sole user of session; checks it when idle.
+        # While it is down, files stay queued until it reconnects.
+        with session.lock:
+            self.restore(session)
+            if sync:
+                try:
+                    self.sync(session)
+                except Exception as e:
+                    log(f"\nError syncing with {self.host}:\n\t{repr(e)}", error = True)
+        while True:
+            paths = self.uploads.claim(_MAX_BATCH if self.config["batch"] else 1,
+                                       timeout = _KEEPALIVE)
+            for path in paths: # kept while re-queued, e.g. while the host is down
+                self.settled.setdefault(path, self.uploads.settled(path))
+            with session.lock:
+                if not paths:
+                    try:
+                        self.keepalive(session)
+                    except Exception as e:
+                        log(f"\nError checking connection{session.name}:\n\t{repr(e)}",
+                            error = True)
+                        session.close()
+                    self.restore(session, lost = True)
+                    continue
+                try:
+                    if len(paths) > 1:
+                        self.handle_batch(session, paths)
+                    else:
+                        self.handle(session, paths[0])
+                except Exception as e:
+                    log(f"\nError handling {', '.join(paths)}:\n\t{repr(e)}", error = True)
+                finally:
+                    self.uploads.done(paths)
+                    for path in paths:
+                        if path not in self.uploads.pending:
+                            self.settled.pop(path, None)
+                if not session.ftp: # lost, with the files re-queued
+                    self.restore(session, lost = True)
+                elif self.uploads.idle(): # burst over
+                    try:
+                        self.verify(session)
+                        if self.uploads.idle(): # none re-queued
+                            self.run_commands(session)
+                    except Exception as e:
+                        log(f"\nError after uploads:\n\t{repr(e)}", error = True)
+                    self.manifest.set_pending([])
+
+    def keepalive(self, session):
+        # Close session if it has failed, to be reconnected
+        if not session.is_ok():
+            session.close()
 
-        # Script-process file and return
-        match = path_matches(path, self.config["process"], key = 'pattern')
-        if match:
+    def restore(self, session, lost = False):
+        # Reconnect session if it's down, whatever goes wrong meanwhile: the
+        # worker must survive to send files still queued
+        while not session.ftp:
             try:
-                subprocess.run((match['script'], path), check = True)
-            except (FileNotFoundError, subprocess.CalledProcessError) as e:
-                log(f"script {match['script']} encountered error:\n\t{repr(e)}", error = True)
+                self.reconnect(session, lost)
+            except Exception as e:
+                log(f"\nError reconnecting{session.name}:\n\t{repr(e)}", error = True)
+                session.close()
+                time.sleep(_BACKOFF_MAX)
+
+    def reconnect(self, session, lost = False):
+        # Connect session, retrying with jittered exponential backoff.
+        # Meanwhile, files keep queueing (coalesced, as ever), and while
+        # every session is down, the queue is saved to the cache, to be
+        # sent after a restart if need be.
+        t0 = time.perf_counter()
+        delay = _BACKOFF_MIN
+        attempts = 0
+        if lost:
+            log(prefix = f"== {cur_time()} ", error = True,
+                msg = f"FTP connection lost{session.name}, reconnecting in the background...")
+        while True:
+            attempts += 1
+            try:
+                session.start()
+            except ConnectionError as e:
+                if attempts == 1:
+                    log(prefix = f"==  Could not connect{session.name} to {self.host}: ",
+                        msg = f"{repr(e.__cause__ or e)}, retrying in the background",
+                        error = True)
+            else:
+                break
+            if not any(s.ftp for s in self.sessions):
+                self.manifest.set_pending(self.uploads.paths())
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, _BACKOFF_MAX)
+        if attempts > 1 or lost:
+            tracer.record("reconnect", t0, host = self.host, attempts = attempts)
+            queued = len(self.uploads.paths())
+            log(prefix = f"== {cur_time()} {'Reconnected' if lost else 'Connected'}{session.name} ",
+                msg = f"after {_BRI}{time.perf_counter()-t0:.1f}s{_RST} ({attempts} attempts)"
+                + (f", sending {queued} queued files" if queued else ''))
+
+    def priority(self, path, t):
+        # Upload order: files triggering the remote command after those they
+        # may depend on, smaller files (by factors of 16) first, then the
+        # most recently saved
+        generated = self.watcher.generated.get(path)
+        try:
+            size = os.path.getsize(path) if generated is None else len(generated)
+        except OSError: # gone: cheap to skip
+            size = 0
+        return (self.watcher.rules.classify(path).remote_match, size.bit_length() // 4, -t)
+
+    def stored(self, session, path, digest):
+        # Note path's upload, for verification once uploads go idle
+        if self.config["verify"] and "XHSH" in session.features:
+            with self.lock:
+                self.unverified[path] = digest
+
+    def verify(self, session):
+        # Check files sent since the last check against the server's hashes
+        # of them, re-queueing any which differ (up to _VERIFY_TRIES sends).
+        # Many files below one (non-root) directory are hashed with it, at
+        # once, others one by one, never the whole remote filesystem.
+        with self.lock:
+            sent, self.unverified = self.unverified, {}
+        if not sent: return
+        t0 = time.perf_counter()
+        common = os.path.commonpath([os.path.dirname(p) for p in sent])
+        if common and len(sent) >= _VERIFY_DIR:
+            remote = session.hashes(common)
+        else:
+            remote = {path: session.hash(path) for path in sent}
+        bad = [path for path, digest in sent.items()
+               if (remote.get(path) or (0, None))[1] != digest]
+        for path in sent.keys() - set(bad):
+            self.failures.pop(path, None)
+        retry = []
+        for path in bad:
+            self.manifest.forget(path)
+            self.bases.pop(path, None)
+            self.failures[path] += 1
+            if self.failures[path] < _VERIFY_TRIES:
+                self.uploads.put(path)
+                retry.append(path)
+        if bad:
+            log(prefix = f"== {cur_time()}{self.tag} Verification failed: ", error = True,
+                msg = ", ".join(bad) + (f" (re-queued: {', '.join(retry)})" if retry else
+                                        ", giving up"))
+        else:
+            log(prefix = f"== {cur_time()}{self.tag} Verified {len(sent)} files ",
+                msg = f"in {_BRI}{time.perf_counter()-t0:.2}s{_RST}")
+
+    def supersede(self, path):
+        # A newer version of path arrived: abort any transfer of the old one.
+        # Its store raises Superseded, and the new version is queued.
+        stream = self.storing.get(path)
+        if stream:
+            stream.aborted.set()
+
+    def counts(self):
+        return f"({self.sent} sent, {self.skipped} skipped)"
+
+    def summary(self):
+        # Files sent, and (for several hosts) connection status and latency
+        if self.tag:
+            up = sum(1 for session in self.sessions if session.ftp)
+            status = ("up" if up == len(self.sessions) else "down" if not up else
+                      f"{up}/{len(self.sessions)} up")
+            lat = sorted(self.latencies)
+            if lat:
+                status += (f", latency p50 {lat[len(lat)//2]*1000:.0f}ms"
+                           f" max {lat[-1]*1000:.0f}ms")
+            log(prefix = f"== {self.host}: {status} {self.counts()}\n")
+        else:
+            log(prefix = f"== Files {self.counts()}\n")
+        if self.wire_bytes:
+            saved = f", ~{self.time_saved:.2}s saved" if self.time_saved else ''
+            log(prefix = f"== Compressed {self.raw_bytes/1024:.1f}KB to "
+                f"{self.wire_bytes/1024:.1f}KB ({self.raw_bytes/self.wire_bytes:.1f}x)"
+                f"{saved}\n")
+
+    def up_delete(self, path, digest):
+        # Delete local path once every host has its content (of digest)
+        if (self.watcher.rules.classify(path).up_delete and
+            path not in self.watcher.generated and
+            self.watcher.delivered(path, digest, self.host)):
+            if self.config["dry-run"]:
+                log(" [would have deleted]", dry_run = True)
             else:
-                log(f"ran script {match['script']} in {_BRI}{time.perf_counter()-t0:.2}s{_RST}")
+                os.remove(path)
+                log(" [local file deleted]")
+        else:
+            log()
+
+    def store(self, session, path, data, digest):
+        # Send data (of sha256 digest) to remote path, resuming a transfer cut
+        # off earlier, or as a patch against the content last sent, or
+        # compressed, if possible.  Returns a note on the transfer for the log.
+        note, payload = '', None
+        offset = self.resume_offset(session, path, data, digest)
+        if offset:
+            self.timed_stor(session, "STOR " + path, data, digest, offset)
+            if self.arrived(session, path, digest, len(data)):
+                note = f" [resumed at {offset}/{len(data)} bytes]"
+                payload = data
+            else: # send it all
+                note = " [resume failed check]"
+        base = self.bases.get(path) if self.config["delta"] else None
+        if (payload is None and base is not None and  # XHSH: the server checks the base
+            {"XPAT", "XHSH"} <= session.features):
+            patch = make_patch(base, data)
+            if len(patch) < len(data):
+                try:
+                    self.timed_stor(session, "XPAT " + path, patch)
+                except ftplib.error_perm as e: # e.g. remote changed: send it all
+                    note = f" [delta refused: {e.args[0][:3]}]"
+                else:
+                    note = f" [delta: {len(patch)}/{len(data)} bytes]"
+                    payload = patch
+        if (payload is None and self.config["compress"] and "XDFL" in session.features
+            and len(data) >= _MIN_COMPRESS):
+            deflated = deflate(data)
+            if len(deflated) < 0.9 * len(data): # else incompressible
+                self.timed_stor(session, "XDFL " + path, deflated, digest)
+                note = f" [deflated {len(data)/len(deflated):.1f}x"
+                if self.rate: # estimate from the best data rate seen
+                    saved = (len(data) - len(deflated)) / self.rate
+                    note += f", ~{saved:.2}s saved"
+                    with self.lock:
+                        self.time_saved += saved
+                with self.lock:
+                    self.raw_bytes += len(data)
+                    self.wire_bytes += len(deflated)
+                note += "]"
+                payload = deflated
+        if payload is None:
+            self.timed_stor(session, "STOR " + path, data, digest)
+        if self.config["delta"]:
+            self.bases[path] = data
+        return note
+
+    def timed_stor(self, session, cmd, payload, digest = None, rest = 0):
+        # Send payload, from offset rest, tracking the best data rate of larger
+        # transfers, whose time is dominated by bandwidth rather than round
+        # trips.  digest is that of the file's content if a transfer cut off
+        # after sending some of it leaves a prefix on the remote, which can
+        # then be resumed.
+        t0 = time.perf_counter()
+        verb, _, path = cmd.partition(' ')
+        stream = self.storing[path] = AbortableStream(payload)
+        stream.seek(rest)
+        try:
+            session.ftp.storbinary(cmd, stream, rest = rest or None)
+        except (OSError, EOFError):
+            if digest and stream.tell() > rest: # some of it may be there
+                self.partial[path] = digest, stream.tell()
+            raise
+        finally:
+            del self.storing[path]
+        if stream.aborted.is_set() and stream.tell() < len(payload): # remote incomplete
+            raise Superseded(path)
+        sent = len(payload) - rest
+        tracer.record("stor", t0, host = self.host, path = path, cmd = verb, bytes = sent,
+                      **({"rest": rest} if rest else {}))
+        if sent >= _MIN_RATE_SIZE:
+            rate = sent / max(time.perf_counter() - t0, 1e-6)
+            self.rate = max(self.rate or 0, rate)
+
+    def resume_offset(self, session, path, data, digest):
+        # Bytes of the remote file left by a cut-off transfer of this same
+        # content (data, of digest), after which to resume (with REST), or 0.
+        # The remote file must be no longer than what was sent, and hash
+        # (XHSH) to the same prefix of data: a file not hashable may be an
+        # older version, and is sent whole.
+        partial, sent = self.partial.pop(path, (None, 0))
+        if partial != digest or not {"REST", "XHSH"} <= session.features:
+            return 0
+        try:
+            rsize = session.ftp.size(path)
+        except ftplib.error_perm: # none there
+            return 0
+        if not rsize or rsize > min(sent, len(data) - 1): return 0
+        return rsize if session.hash(path) == (
+            rsize, hashlib.sha256(data[:rsize]).hexdigest()) else 0
+
+    def arrived(self, session, path, digest, size):
+        # Does the remote file hold content of this digest?
+        return session.hash(path) == (size, digest)
+
+    def handle(self, session, path):
+        t0 = time.perf_counter()
+        item = self.prepare(path)
+        if item:
+            self.upload(session, *item, t0)
+
+    def handle_batch(self, session, paths):
+        # Send several files at once, over a single data connection
+        items = []
+        for path in paths:
+            item = self.prepare(path)
+            if item:
+                log(" queued")
+                items.append(item)
+        if not items: return
+        if len(items) == 1 or "XBAT" not in session.features:
+            for item in items:
+                log(prefix=f">> {cur_time()}{self.tag} Sending {_BRI}{item[0]}{_RST}...")
+                self.upload(session, *item, time.perf_counter())
+            return
+        t0 = time.perf_counter()
+        log(prefix=f">> {cur_time()}{self.tag} Sending batch of {len(items)} files...")
+        if self.config["dry-run"]:
+            log("would have uploaded", dry_run = True)
+        else:
+            archive = pack_files((path, data) for path, data, digest in items)
+            try:
+                with tracer.span("stor", host = self.host, cmd = "XBAT", files = len(items),
+                                 bytes = len(archive)):
+                    session.ftp.storbinary("XBAT", io.BytesIO(archive))
+            except (ftplib.error_perm, ftplib.error_temp, ConnectionError,
+                    TimeoutError, EOFError, OSError) as e: # send them one by one instead
+                if isinstance(e, (OSError, EOFError)) or not session.is_ok():
+                    # connection lost: keep them for when it's back
+                    log(f" batch failed ({repr(e)}), re-queued", error = True)
+                    session.close()
+                    for item in items:
+                        self.uploads.put(item[0])
+                    return
+                log(f" batch failed ({repr(e)}), sending separately", error = True)
+                for item in items:
+                    log(prefix=f">> {cur_time()}{self.tag} Sending {_BRI}{item[0]}{_RST}...")
+                    self.upload(session, *item, time.perf_counter())
+                return
+            for path, data, digest in items:
+                session.rdirs.update(parents(os.path.dirname(path)))
+                self.manifest.update(path, digest, len(data))
+                self.stored(session, path, digest)
+                tracer.record("upload", t0, host = self.host, path = path)
+                if self.config["delta"]:
+                    self.bases[path] = data
+            with self.lock:
+                self.sent += len(items)
+                self.latencies.extend(time.perf_counter() - self.settled[path]
+                                      for path, data, digest in items)
+            log(f" transferred in {_BRI}{time.perf_counter()-t0:.2}s{_RST} {self.counts()}")
+        for path, data, digest in items:
+            if self.watcher.rules.classify(path).up_delete:
+                log(prefix = f"   {path}", end = '')
+                self.up_delete(path, digest)
+            self.defer_command(path)
+
+    def prepare(self, path):
+        # Read path (or take a mapped script output's content) for upload.
+        # Returns (path, data, digest) if path should be uploaded.
+        data = self.watcher.generated.get(path)
+        path = os.path.relpath(path)
+        if data is None and not os.path.isfile(path): # deleted since queued
+            log(prefix = f">> {cur_time()}{self.tag} {path} ", msg = "gone, skipped")
+            return
+        
+        log(prefix=f">> {cur_time()}{self.tag} Processing {_BRI}{path}{_RST}...")
+
+        # Skip files whose content was already uploaded
+        t0 = time.perf_counter()
+        if data is None:
+            data, digest = self.watcher.read(path, self.host)
+        else:
+            digest = hashlib.sha256(data).hexdigest()
+        tracer.record("read", t0, host = self.host, path = path, bytes = len(data))
+        if not self.config["force"] and self.manifest.unchanged(path, digest, len(data)):
+            with self.lock:
+                self.skipped += 1
+            log(f" unchanged, skipped {self.counts()}", end = '', flush = True)
+            self.up_delete(path, digest)
             return
+        return path, data, digest
 
+    def upload(self, session, path, data, digest, t0):
         # Upload file, optionally remove, and possibly execute remote command
-        subdir = None
+        subdir = os.path.dirname(path)
+        retried = False
         tries = 0
         while tries<5:
             try:
-                if subdir is not None:
-                    if not self.is_ok(): raise ConnectionError
-                    self.mkdirs(subdir)
-                    log("success: ", end = '')
                 if self.config["dry-run"]:
                     log("would have uploaded", dry_run = True, end = '', flush = True)
                 else: 
-                    with open(path,"rb") as f:
-                        self.ftp.storbinary("STOR " + path, f)
-                    log(f" transferred in {_BRI}{time.perf_counter()-t0:.2}s{_RST}",
-                        end='', flush = True)
-            except (ConnectionError, TimeoutError, EOFError):
-                log(prefix = "\n==  ",
-                    msg = "FTP connection problem, attempting restart...", error = True)
-                self.ftp_start()
+                    session.mkdirs(subdir)
+                    note = self.store(session, path, data, digest)
+                    self.manifest.update(path, digest, len(data))
+                    self.stored(session, path, digest)
+                    tracer.record("upload", t0, host = self.host, path = path)
+                    with self.lock:
+                        self.sent += 1
+                        self.latencies.append(time.perf_counter() - self.settled[path])
+                    log(f"{note} transferred in {_BRI}{time.perf_counter()-t0:.2}s{_RST} "
+                        f"{self.counts()}", end='', flush = True)
+            except (ConnectionError, TimeoutError, EOFError, OSError) as e:
+                log(f" connection failed ({repr(e)}), re-queued", error = True)
+                session.close()
+                self.uploads.put(path)
+                return
+            except Superseded:
+                self.manifest.forget(path)
+                self.bases.pop(path, None)
+                log(f" superseded after {time.perf_counter()-t0:.2}s, re-queued",
+                    error = True, flush = True)
+                return
+            except ftplib.error_temp as e: # e.g. server busy with another session
+                log(f" [{e.args[0][:3]}, retrying]", error = True, end = '', flush = True)
+                time.sleep(0.1 * (tries + 1))
             except ftplib.error_perm as e:
-                if subdir is not None: # already tried subdir creation 
+                if retried: # already tried subdir re-creation
                     log(f"Failed to transfer file {path}, aborting:\n\t{repr(e)}",
                         error = True, flush = True)
                     return
-                if e.args[0].startswith('550'):
-                    subdir = os.path.dirname(path)
-                    if subdir != '.':
-                        log(f"failed\n>> attempting remote directory creation: {subdir}...",
-                            error = True, flush = True, end = '')
-                        continue
+                if e.args[0].startswith('550') and subdir:
+                    # Directory removed behind our back?  Forget and re-create it
+                    retried = True
+                    session.rdirs = {d for d in session.rdirs
+                                     if not (subdir + os.sep).startswith(d + os.sep)}
+                    log(f"failed\n>> attempting remote directory creation: {subdir}...",
+                        error = True, flush = True, end = '')
+                    continue
                 log("\nUnhandled FTP error: " + repr(e), error = True)
                 return
             else: # Successfully uploaded path!
-                if path_matches(path, self.config["up-delete"]):
-                    if config["dry-run"]:
-                        log(" [would have deleted]", dry_run = True)
-                    else:
-                        os.remove(path)
-                        log(" [local file deleted]")
-                else:
-                    log()
-                if self.config["remote-command"] and (not self.config["remote-match"] or
-                                                      path_matches(path, self.config["remote-match"])):
-                    cmd = self.config["remote-command"]
-                    cmd = cmd.replace('%%f', os.path.basename(path).split('.')[0])
-                    if config["dry-run"]:
-                        cmd = '\t' + cmd.replace('\0','\n\t')
-                        log(prefix = "** ",msg = f"Would have run command:\n{cmd}",
-                            dry_run = True)
-                    else:
-                        try:
-                            self.ftp.voidcmd("SITE " + cmd)
-                        except (ftplib.error_reply, ftplib.error_perm) as e:
-                            cmd = '\t' + cmd.replace('\0','\n\t')
-                            log(error = True, prefix = "** ",
-                                msg = f"Remote command failed:\n{cmd}\n\t" + repr(e))
-                        else:
-                            cmd = '\t' + cmd.replace('\n','\n\t')
-                            log(prefix = "** Ran remote command:\n", msg = cmd)
+                self.up_delete(path, digest)
+                self.defer_command(path)
                 return
             tries += 1
-        if tries == 5:
-            log("FTP re-connect failed, file not transfered, aborting", error = True)
+        if tries == 5: # server still busy
+            log(" re-queued", error = True)
+            self.uploads.put(path)
+
+    def defer_command(self, path):
+        # Note the remote command due after uploading path, run once uploads
+        # go idle, so a burst of files costs one command
+        if self.config["remote-command"] and (not self.config["remote-match"] or
+                                              self.watcher.rules.classify(path).remote_match):
+            with self.lock:
+                self.commands.setdefault(os.path.basename(path).split('.')[0], path)
+
+    def remote_command(self, names):
+        # The command for a burst of files with basenames names: %%F is
+        # replaced by all of them, and each line with %%f is repeated for
+        # each; identical lines are sent once
+        lines = []
+        for line in self.config["remote-command"].replace('%%F', repr(tuple(names))).split('\0'):
+            if '%%f' in line:
+                lines.extend(line.replace('%%f', name) for name in names)
+            else:
+                lines.append(line)
+        return '\0'.join(dict.fromkeys(lines))
+
+    def run_commands(self, session):
+        # Run the remote command for files uploaded since it last ran
+        with self.lock:
+            names, self.commands = list(self.commands), {}
+        if not names: return
+        cmd = self.remote_command(names)
+        files = f" ({len(names)} files)" if len(names) > 1 else ''
+        if self.config["dry-run"]:
+            cmd = '\t' + cmd.replace('\0','\n\t')
+            log(prefix = f"**{self.tag} ",msg = f"Would have run command{files}:\n{cmd}",
+                dry_run = True)
+        else:
+            try:
+                with tracer.span("site", host = self.host, files = len(names)):
+                    session.ftp.voidcmd("SITE " + cmd)
+            except (ftplib.error_reply, ftplib.error_perm) as e:
+                cmd = '\t' + cmd.replace('\0','\n\t')
+                log(error = True, prefix = f"**{self.tag} ",
+                    msg = f"Remote command failed:\n{cmd}\n\t" + repr(e))
+            else:
+                cmd = '\t' + cmd.replace('\0','\n\t')
+                log(prefix = f"**{self.tag} Ran remote command{files}:\n", msg = cmd)
+
+if Inotify:
+    class PrunedInotify(Inotify):
+        # A recursive inotify instance which walks and watches no directory
+        # excluded(path).  Those get a placeholder watch descriptor instead,
+        # which the kernel never reports, so watchdog's bookkeeping (e.g. the
+        # events it simulates for a new tree) still finds them.
+        placeholders = itertools.count(-2, -1)
+
+        def __init__(self, path, excluded, **kw):
+            self.excluded = excluded
+            super().__init__(path, **kw)
+
+        def _add_dir_watch(self, path, mask, *, recursive):
+            if not os.path.isdir(path):
+                raise NotADirectoryError(path)
+            self._add_watch(path, mask)
+            if recursive:
+                for root, dirs, _ in os.walk(path):
+                    dirs[:] = [d for d in dirs if not self.excluded(os.path.join(root, d))]
+                    for d in dirs:
+                        if not os.path.islink(os.path.join(root, d)):
+                            self._add_watch(os.path.join(root, d), mask)
+
+        def _add_watch(self, path, mask):
+            if path == self._path or not self.excluded(path):
+                return super()._add_watch(path, mask)
+            wd = next(self.placeholders)
+            self._wd_for_path[path] = wd
+            self._path_for_wd[wd] = path
+            return wd
+
+    def pruned_observer(excluded):
+        # An inotify observer whose recursive watches skip any directory
+        # excluded(relative path), all in one inotify instance
+        def skip(path):
+            return excluded(os.path.relpath(os.fsdecode(path)))
+
+        class Buffer(InotifyBuffer):
+            def __init__(self, path, *, recursive = False, event_mask = None):
+                super(InotifyBuffer, self).__init__()
+                self._queue = DelayedQueue(self.delay)
+                self._inotify = PrunedInotify(path, skip, recursive = recursive,
+                                              event_mask = event_mask)
+                self.start()
+
+        class Emitter(InotifyEmitter):
+            def on_thread_start(self):
+                self._inotify = Buffer(os.fsencode(self.watch.path),
+                                       recursive = self.watch.is_recursive,
+                                       event_mask = self.get_event_mask_from_filter())
+
+        observer = BaseObserver(Emitter)
+        observer.prunes = True
+        return observer
+else:
+    pruned_observer = None
+
+class FTPWatcher(FileSystemEventHandler):
+    def __init__(self, config):
+        global log_buffered
+        super().__init__()
+        ignore = config["exclude"] + ["*.autoftp-cache*", ".autoftp-cache.d/*"]
+        if config["trace"]:
+            ignore.append(os.path.relpath(config["trace"]))
+        self.rules = Rules(config, ignore)
+        self.config = config
+        self.lock = threading.Lock()
+        self.scripts = SettleQueue(config["settle"], "script-queue")
+        self.procs = {} # path -> running script process
+        self.watches = {} # directory -> (ObservedWatch, recursive)
+        self.pruning = True # planning watches around excluded directories: False
+                            # if the observer prunes them itself, or too many
+                            # watches forced one for the whole tree
+        self.outputs = (OutputCache(config["output-cache"] * 2**20)
+                        if config["output-cache"] > 0 else None)
+        self.delivered_to = {} # (path, digest) -> hosts which have it, for up-delete
+        self.generated = {} # path -> content of mapped script outputs, never on disk
+        self.contents = {} # path -> (stat, data, digest, hosts yet to read it)
+        log_buffered = (len(config["host"]) > 1 or config["connections"] > 1 or
+                        bool(config["process"])) # scripts run beside uploads
+        self.uploaders = []
+        for host in config["host"]:
+            self.uploaders.append(Uploader(self, host, self.uploaders and
+                                           self.uploaders[0].manifest))
+
+    def start(self):
+        for uploader in self.uploaders:
+            uploader.start()
+        if self.config["process"]:
+            for i in range(max(1, self.config["jobs"])):
+                threading.Thread(target = self.run_scripts, daemon = True).start()
+
+    def wanted(self, path):
+        match = self.rules.classify(path)
+        return (match.include or bool(match.process)) and not match.exclude
+
+    def watch(self, observer, top = '.'):
+        # Watch top's tree, skipping excluded directories: a pruned_observer
+        # skips them in one recursive watch, otherwise directories which
+        # contain excluded ones are watched alone, other subtrees recursively.
+        # If that takes over _MAX_WATCHES, the whole tree is watched with one
+        # instead, and excluded trees' events just ignored.  Returns the
+        # number of directories watched.
+        self.observer = observer
+        top = os.path.relpath(top)
+        kept, blocked = [], set() # blocked: dirs with excluded dirs below
+        for root, dirs, files in os.walk(top):
+            root = os.path.relpath(root)
+            kept.append(root)
+            pruned = [d for d in dirs if not self.rules.excluded_dir(os.path.join(root, d))]
+            if len(pruned) < len(dirs):
+                cur = root
+                while cur not in blocked:
+                    blocked.add(cur)
+                    if cur == top: break
+                    cur = os.path.dirname(cur) or '.'
+            dirs[:] = pruned
+        if getattr(observer, 'prunes', False):
+            self.pruning = False
+            self.schedule(top, True)
+            return len(kept)
+        plan = [(d, d not in blocked) for d in kept
+                if d in blocked or d == top or (os.path.dirname(d) or '.') in blocked]
+        if self.pruning and len(self.watches) + len(plan) > _MAX_WATCHES:
+            log(prefix = '%% ', msg = f"Over {_MAX_WATCHES} watches needed to skip "
+                "excluded directories: watching all")
+            self.pruning = False
+            self.unwatch('.')
+            self.schedule('.', True)
+            return sum(1 for _ in os.walk('.'))
+        for d, recursive in plan:
+            self.schedule(d, recursive)
+        return len(kept)
+
+    def schedule(self, d, recursive):
+        self.watches[d] = (self.observer.schedule(self, d, recursive = recursive), recursive)
+
+    def unwatch(self, top):
+        # Stop watching top's tree
+        for d in [d for d in self.watches if d == top or d.startswith(top + os.sep)
+                  or top == '.']:
+            try:
+                self.observer.unschedule(self.watches.pop(d)[0])
+            except KeyError: # already gone with its directory
+                pass
+
+    def add_dir(self, d):
+        # A directory appeared (or moved in): watch it, unless already covered
+        # by a recursive watch, which might now hold an excluded directory
+        d = os.path.relpath(d)
+        parent = os.path.dirname(d) or '.'
+        cover = parent
+        while cover not in self.watches and cover != '.':
+            cover = os.path.dirname(cover) or '.'
+        if cover in self.watches and self.watches[cover][1]: # recursive
+            if self.pruning and self.rules.excluded_dir(d):
+                self.unwatch(cover)
+                self.watch(self.observer, cover)
+            return
+        if self.rules.excluded_dir(d) or parent not in self.watches: return
+        self.watch(self.observer, d)
+        for root, dirs, files in os.walk(d): # files which beat the watch
+            dirs[:] = [x for x in dirs if not self.rules.excluded_dir(os.path.join(root, x))]
+            for name in files:
+                self.enqueue(os.path.join(root, name))
+
+    def on_moved(self, event):
+        if event.is_directory:
+            self.unwatch(os.path.relpath(event.src_path))
+            self.add_dir(event.dest_path)
+        else:
+            self.enqueue(event.dest_path)
+
+    def on_created(self, event):
+        if event.is_directory:
+            self.add_dir(event.src_path)
+        else:
+            self.enqueue(event.src_path)
+
+    def on_deleted(self, event):
+        if event.is_directory:
+            self.unwatch(os.path.relpath(event.src_path))
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.enqueue(event.src_path)
+
+    def enqueue(self, path):
+        # Called on the observer thread: just note the event; repeated events
+        # for the same path coalesce, and restart its settle window.  A newer
+        # version of a file being processed stops its running script.
+        path = os.path.relpath(path)
+        if not self.wanted(path): return
+        if self.rules.classify(path).process:
+            if self.scripts.put(path):
+                proc = self.procs.get(path)
+                if proc: proc.kill()
+        else:
+            self.upload(path)
+
+    def upload(self, path):
+        for uploader in self.uploaders:
+            if uploader.uploads.put(path):
+                uploader.supersede(path)
+
+    def delivered(self, path, digest, host):
+        # Note that host has path's content of digest.  Returns whether all
+        # hosts now have that content, forgetting path if so.
+        with self.lock:
+            hosts = self.delivered_to.setdefault((path, digest), set())
+            hosts.add(host)
+            if len(hosts) < len(self.uploaders): return False
+            for key in [key for key in self.delivered_to if key[0] == path]:
+                del self.delivered_to[key]
+            return True
+
+    def read(self, path, host):
+        # Content of local path and its sha256 digest, read and hashed once
+        # for all hosts: kept (by path, and stat) until each has read it
+        st = os.stat(path)
+        key = st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino
+        with self.lock:
+            entry = self.contents.get(path)
+            if entry and entry[0] == key:
+                entry[3].discard(host)
+                if not entry[3]:
+                    del self.contents[path]
+                return entry[1], entry[2]
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        others = {uploader.host for uploader in self.uploaders} - {host}
+        if others:
+            with self.lock:
+                self.contents[path] = key, data, digest, others
+        return data, digest
+
+    def processed(self, path, digest, size):
+        for uploader in self.uploaders:
+            uploader.manifest.update(path, digest, size, uploader.manifest.processed)
+
+    def run_scripts(self):
+        while True:
+            path, = self.scripts.claim()
+            try:
+                self.process(path)
+            except Exception as e:
+                log(f"\nError processing {path}:\n\t{repr(e)}", error = True)
+            finally:
+                self.scripts.done((path,))
+
+    def process(self, path):
+        # Script-process file, or restore its cached outputs
+        if not os.path.isfile(path): return
+        match = self.rules.classify(path).process
+        log(prefix=f">> {cur_time()} Processing {_BRI}{path}{_RST}...")
+        t0 = time.perf_counter()
+        with open(path,"rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if self.outputs:
+            key = self.outputs.key(match['script'], path, data, match['output'], match['stdout'])
+            outputs = self.outputs.get(key)
+            if outputs:
+                for opath, odata in outputs:
+                    if match.get('output'):
+                        self.generated[opath] = odata
+                    else:
+                        with open(opath, "wb") as f:
+                            f.write(odata)
+                    self.upload(opath)
+                self.processed(path, digest, len(data))
+                tracer.record("script", t0, path = path, script = match['script'],
+                              cached = True)
+                log(f"restored {len(outputs)} output(s) of {match['script']} "
+                    f"{self.outputs.counts()}")
+                return
+            before = self.siblings(path)
+        if match.get('output'):
+            result = self.run_mapped(path, match, data)
+        else:
+            result = self.run_script(match['script'], path)
+        if result is None: return
+        ret, outputs = result
+        tracer.record("script", t0, path = path, script = match['script'], status = ret)
+        if path in self.scripts.pending and ret != 0: # killed: newer version waiting
+            log(f"script {match['script']} superseded by newer changes")
+        elif ret != 0:
+            e = subprocess.CalledProcessError(ret, (match['script'], path))
+            log(f"script {match['script']} encountered error:\n\t{repr(e)}", error = True)
+        elif match.get('output') and not outputs: # don't overwrite the remote with nothing
+            what = "output" if match['stdout'] else map_output(path, match['pattern'],
+                                                               match['output'])
+            log(f"script {match['script']} wrote no {what}, nothing uploaded", error = True)
+        else:
+            self.processed(path, digest, len(data))
+            counts = ''
+            if match.get('output'):
+                for opath, odata in outputs:
+                    self.generated[opath] = odata
+                    self.upload(opath)
+                if self.outputs:
+                    self.outputs.put(key, outputs)
+                    counts = " " + self.outputs.counts()
+            elif self.outputs:
+                outputs = []
+                for opath, stat in self.siblings(path).items():
+                    if before.get(opath) != stat:
+                        with open(opath, "rb") as f:
+                            outputs.append((opath, f.read()))
+                if outputs:
+                    self.outputs.put(key, outputs)
+                counts = " " + self.outputs.counts()
+            log(f"ran script {match['script']} in {_BRI}{time.perf_counter()-t0:.2}s{_RST}"
+                f"{counts}")
+
+    def run_script(self, script, path, cwd = None, stdout = None):
+        # Run script on path, stoppable by a newer version of the file.
+        # Returns its exit status and (if stdout is subprocess.PIPE) standard
+        # output, or None if it can't be run.
+        try:
+            proc = subprocess.Popen((script, path), cwd = cwd, stdout = stdout)
+        except FileNotFoundError as e:
+            log(f"script {script} encountered error:\n\t{repr(e)}", error = True)
+            return None
+        self.procs[path] = proc
+        try:
+            out, _ = proc.communicate()
+        finally:
+            del self.procs[path]
+        return proc.returncode, out
+
+    def run_mapped(self, path, match, data):
+        # Run the script of a rule with an output mapping on a copy of path's
+        # content (data) in a temporary directory, outside the watched tree.
+        # Its output is the file it writes there under the mapped name, or
+        # for 'pat |> out' rules, its standard output.  Returns the exit
+        # status and [(output path, content)] (empty if it wrote nothing), or
+        # None.
+        opath = map_output(path, match['pattern'], match['output'])
+        script = match['script']
+        if os.path.dirname(script): # relative to here, not the copy
+            script = os.path.abspath(script)
+        with tempfile.TemporaryDirectory(prefix = "autoftp-") as tmp:
+            os.makedirs(os.path.join(tmp, os.path.dirname(path)), exist_ok = True)
+            with open(os.path.join(tmp, path), "wb") as f:
+                f.write(data)
+            result = self.run_script(script, path, cwd = tmp,
+                                     stdout = subprocess.PIPE if match['stdout'] else None)
+            if result is None: return None
+            ret, out = result
+            if not match['stdout']:
+                try:
+                    with open(os.path.join(tmp, opath), "rb") as f:
+                        out = f.read()
+                except OSError:
+                    out = None
+        return ret, [(opath, out)] if out else []
+
+    def siblings(self, path):
+        # Files beside path sharing its base name (e.g. a.mpy for a.py), the
+        # likely outputs of a processing script, with their mtime and size
+        stem = os.path.basename(path).split('.')[0]
+        files = {}
+        for entry in os.scandir(os.path.dirname(path) or '.'):
+            opath = os.path.relpath(entry.path)
+            if (entry.is_file() and entry.name.split('.')[0] == stem and opath != path
+                and self.wanted(opath)):
+                stat = entry.stat()
+                files[opath] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def summary(self):
+        for uploader in self.uploaders:
+            uploader.summary()
+
+class Poller(threading.Thread):
+    """Watches the tree by polling, for filesystems which deliver no change
+    events (bind mounts, network shares...).  Keeps an index of the
+    directories the rules don't exclude, with the mtime and size of wanted
+    files in each; a directory is only re-listed when its mtime changes,
+    otherwise just its wanted files are checked.  Scans run every interval
+    seconds, but less often if needed to hold scanning to cpu percent."""
+    def __init__(self, handler, interval, cpu, top = '.'):
+        super().__init__(daemon = True)
+        self.handler = handler
+        self.interval = interval
+        self.cpu = cpu
+        self.top = os.path.relpath(top)
+        self.dirs = {} # dir -> [mtime_ns, {name: (mtime_ns, size)}, [subdirs]]
+        self.stopped = threading.Event()
+        self.scan(initial = True)
+
+    def files(self):
+        return sum(len(entry[1]) for entry in self.dirs.values())
+
+    def run(self):
+        delay = self.interval
+        while not self.stopped.wait(delay):
+            t0 = time.perf_counter()
+            for path in self.scan():
+                self.handler.enqueue(path)
+            t = time.perf_counter() - t0
+            tracer.record("poll", t0, dirs = len(self.dirs))
+            delay = max(self.interval - t, t * (100 / self.cpu - 1))
+
+    def stop(self):
+        self.stopped.set()
+
+    def scan(self, initial = False):
+        # Update the index, returning the wanted files changed since last scan
+        changed, stack = [], [self.top]
+        rules, wanted = self.handler.rules, self.handler.wanted
+        while stack:
+            d = stack.pop()
+            try:
+                mtime = os.stat(d).st_mtime_ns
+            except OSError: # removed
+                self.forget(d)
+                continue
+            entry = self.dirs.get(d)
+            # Re-list changed directories, and recently changed ones, whose
+            # mtime might not reflect changes within its resolution
+            if not entry or entry[0] != mtime or time.time_ns() - mtime < 2 * 10**9:
+                old = entry[1] if entry else {}
+                files, subdirs = {}, []
+                try:
+                    with os.scandir(d) as it:
+                        for e in it:
+                            path = os.path.join(d, e.name) if d != '.' else e.name
+                            try:
+                                if e.is_dir(follow_symlinks = False):
+                                    if not rules.excluded_dir(path):
+                                        subdirs.append(path)
+                                elif e.is_file() and wanted(path):
+                                    st = e.stat()
+                                    files[e.name] = (st.st_mtime_ns, st.st_size)
+                                    if not initial and old.get(e.name) != files[e.name]:
+                                        changed.append(path)
+                            except OSError: # removed since listed
+                                continue
+                except OSError:
+                    self.forget(d)
+                    continue
+                for sub in set(entry[2] if entry else ()) - set(subdirs):
+                    self.forget(sub)
+                self.dirs[d] = entry = [mtime, files, subdirs]
+            else: # stat files relative to their directory, where supported
+                files = entry[1]
+                try:
+                    fd = os.open(d, os.O_RDONLY) if _STAT_DIR_FD else None
+                except OSError: # removed
+                    self.forget(d)
+                    continue
+                try:
+                    for name, stat in files.items():
+                        try:
+                            st = (os.stat(name, dir_fd = fd) if fd is not None else
+                                  os.stat(os.path.join(d, name)))
+                        except OSError: # removed since listed
+                            continue
+                        if (st.st_mtime_ns, st.st_size) != stat:
+                            files[name] = (st.st_mtime_ns, st.st_size)
+                            changed.append(os.path.join(d, name) if d != '.' else name)
+                finally:
+                    if fd is not None:
+                        os.close(fd)
+            stack.extend(entry[2])
+        return changed
+
+    def forget(self, d):
+        entry = self.dirs.pop(d, None)
+        if entry:
+            for sub in entry[2]:
+                self.forget(sub)
 
 usage = '''
 Usage: autoftp host -d|--debug -n|--dry-run -p|--include=pats -x|--exclude=pats 
-                    -s|--process=pat,script -k|--up-delete=pats
-  host: FTP host to connect to
+                    -s|--process=pat,script -k|--up-delete=pats -w|--settle=secs
+                    -f|--force -c|--connections=N -y|--sync -D|--delta
+                    -z|--compress -b|--batch -j|--jobs=N -O|--output-cache=MB
+                    -T|--trace=file -S|--stats -P|--poll=secs -C|--poll-cpu=pct
+                    -V|--verify
+  host: FTP host to connect to; several hosts ('host,host,...') are each
+                              sent every file, independently
   -d|--debug: Enable debugging output
   -n|--dry-run: Uploads and local deletes are logged, but do not occur
   -p|--include='pat,pat,...': include patterns of files to match for upload
                               (default: '*.py')
-  -x|--exclude='pat,pat,...': patterns to ignore (e.g. '*lib/*,secret*.py')
+  -x|--exclude='pat,pat,...': patterns to ignore (e.g. '*lib/*,secret*.py');
+                              patterns ending in '/' exclude directories and
+                              all below them, unwatched (e.g. '.git/,build/')
   -s|--process='pat,script' : instead of uploading, run `script' on each file
-                              matching `pat' (can pass multiple times)
+                              matching `pat' (can pass multiple times).  With
+                              'pat -> out,script' (e.g. '*.py -> *.mpy'), the
+                              file `out' it writes (run on a copy of the file,
+                              elsewhere) is uploaded directly from memory,
+                              without writing it locally; with 'pat |> out',
+                              its standard output is uploaded as `out'
   -k|--up-delete='pat,pat,..': delete files match any of the patterns, after
                               they have been successfully uploaded
   -r|--remote-command='command': command to execute on the remote (ftp) server 
-                              after each uploaded file. %%f will be replaced by 
-                              the file basename of the uploaded file
+                              after uploading files, once uploads go idle.
+                              %%f will be replaced by the file basename of
+                              each uploaded file (repeating each line with
+                              %%f for each distinct name), %%F by a tuple of
+                              them all
   -m|--remote-match='pat,pat': only execute --remote-command on uploaded
                               files which match one of these patterns
+  -w|--settle=secs: wait for a file's events to settle this long before
+                              handling it; bursts of events for the same file
+                              are merged into one upload (default: 0.2)
+  -f|--force: upload files even if their content is unchanged since last
+                              uploaded (as recorded in `.autoftp-cache')
+  -c|--connections=N: upload over N parallel FTP sessions (default: 1); a
+                              given file is never sent by two at once
+  -y|--sync: on startup, send (or process) files which differ from those on
+                              the remote, before watching for changes
+  -V|--verify: after each burst of uploads, check the files arrived intact
+                              against hashes from the server, and re-send any
+                              which did not, if the server supports it (see
+                              example/lib/uftpd.py)
+  -D|--delta: send only the changes to files uploaded earlier in the session,
+                              if the server supports it (see example/lib/uftpd.py)
+  -z|--compress: send files compressed, if the server supports it (see
+                              example/lib/uftpd.py)
+  -b|--batch: send bursts of several files together over one data
+                              connection, if the server supports it (see
+                              example/lib/uftpd.py)
+  -j|--jobs=N: run up to N --process scripts at once (default: the number
+                              of CPUs)
+  -O|--output-cache=MB: cache up to MB of --process script outputs, and
+                              restore them rather than re-running scripts
+                              on content seen before (default: 32, 0: off)
+  -T|--trace=file: append the duration of each stage of handling files
+                              (queueing, scripts, connecting, mkdir, STOR,
+                              SITE...) to file, as JSON lines
+  -S|--stats: on exit, summarize the durations of each stage
+  -P|--poll=secs: detect changes by scanning the tree every secs, for
+                              filesystems without change events (e.g. bind
+                              mounts, network shares)
+  -C|--poll-cpu=pct: scan less often if needed to hold --poll scanning to
+                              pct% of a CPU (default: 10)
 
 Options can also be specified in a `.autoftp' file in the current directory, 
 using the format:
@@ -232,7 +1880,15 @@ N.B.: options passed via the command line override & extend file-based options.
 '''
 
 if __name__ == "__main__":
-    import re
+    def process_rule(arg):
+        # 'pat,script', 'pat -> output,script' or 'pat |> output,script' (output
+        # from the script's stdout) as a dict, or None if invalid
+        pp = [x.strip() for x in arg.split(",")]
+        if len(pp) != 2: return None
+        arrow = "|>" if "|>" in pp[0] else "->"
+        pattern, _, output = pp[0].partition(arrow)
+        return {"pattern": pattern.strip(), "script": pp[1], "output": output.strip() or None,
+                "stdout": arrow == "|>"}
 
     def read_config_file(config):
         in_remote = False
@@ -252,16 +1908,25 @@ if __name__ == "__main__":
                             in_remote = (k == 'remote-command')
                             arg=line[match.end():]
                             if arg:
-                                if k in ('host','remote-command'):
+                                if k in ('remote-command', 'trace'):
                                     config[k] = arg
+                                elif k in ('settle', 'connections', 'jobs', 'output-cache',
+                                           'poll', 'poll-cpu'):
+                                    try:
+                                        config[k] = type(config[k])(arg)
+                                    except ValueError:
+                                        log(error = True,
+                                            msg = f"Error in .autoftp {k} option: " + usage)
+                                        exit()
                                 elif k == 'process':
-                                    pp = [x.strip() for x in arg.split(",")]
-                                    if len(pp) != 2:
+                                    rule = process_rule(arg)
+                                    if not rule:
                                         log(error = True,
                                             msg = "Error in .autoftp process option: " + usage)
                                         exit()
-                                    config[k].append(dict(zip(("pattern","script"),pp)))
-                                elif k in ('include','exclude','up-delete','remote-match'):
+                                    config[k].append(rule)
+                                elif k in ('host','include','exclude','up-delete',
+                                           'remote-match'):
                                     config[k].extend([x.strip() for x in arg.split(",")])
                             break
                 if not match and in_remote: # Unmatching lines in remote get added
@@ -272,15 +1937,29 @@ if __name__ == "__main__":
 
     welcome = f"{_BRI}AutoFTP {__VERSION__}{_RST}"
     extra_welcome = []
-    config = {"host": None,
+    config = {"host": [],
               "debug": False,
               "dry-run": False,
+              "force": False,
+              "sync": False,
+              "delta": False,
+              "compress": False,
+              "batch": False,
+              "stats": False,
+              "verify": False,
               "include": [],
               "exclude": [],
               "process": [],
               "up-delete": [],
               "remote-command": None,
-              "remote-match": []}
+              "trace": None,
+              "remote-match": [],
+              "settle": 0.2,
+              "connections": 1,
+              "jobs": os.cpu_count() or 1,
+              "output-cache": 32.,
+              "poll": 0.,
+              "poll-cpu": 10.}
 
     #Process .autoftp file options
     if os.path.isfile(".autoftp"):
@@ -290,14 +1969,16 @@ if __name__ == "__main__":
     # Process command line options
     if len(sys.argv) > 1:
         try:
-            opts,args = getopt(sys.argv[1:],"p:x:s:k:r:m:dn",
+            opts,args = getopt(sys.argv[1:],"p:x:s:k:r:m:w:c:j:O:T:P:C:dnfyDzbSV",
                                ["include=","exclude=","process=","up-delete=",'remote-command=',
-                                'remote-match=',"debug","dry-run"])
+                                'remote-match=',"settle=","connections=","jobs=","output-cache=",
+                                "trace=","poll=","poll-cpu=","debug","dry-run",
+                                "force","sync","delta","compress","batch","stats","verify"])
         except GetoptError:
             log(usage, error = True)
             exit()
         if args:
-            config['host'] = args[0]
+            config['host'] = [x.strip() for arg in args for x in arg.split(",")]
 
         for opt,arg in opts:
             if opt in   ("--include", "-p"):
@@ -305,21 +1986,53 @@ if __name__ == "__main__":
             elif opt in ("--exclude", "-x"):
                 config["exclude"].extend([x.strip() for x in arg.split(",")])
             elif opt in ("--process", "-s"):
-                pp = [x.strip() for x in arg.split(",")]
-                if len(pp) != 2:
+                rule = process_rule(arg)
+                if not rule:
                     log("Error in process option: " + usage,error = True)
                     exit()
-                config["process"].append(dict(zip(("pattern","script"),pp)))
+                config["process"].append(rule)
             elif opt in ("--up-delete", "-k"):
                 config["up-delete"].extend([x.strip() for x in arg.split(",")])
             elif opt in ("--remote-command", "-r"):
                 config["remote-command"] = arg
             elif opt in ("--remote-match", "-m"):
                 config["remote-match"].extend([x.strip() for x in arg.split(",")])
+            elif opt in ("--settle", "-w", "--output-cache", "-O", "--poll", "-P",
+                         "--poll-cpu", "-C"):
+                k = (opt[2:] if opt.startswith("--") else
+                     {"-w": "settle", "-O": "output-cache", "-P": "poll", "-C": "poll-cpu"}[opt])
+                try:
+                    config[k] = float(arg)
+                except ValueError:
+                    log(f"Error in {k} option: " + usage, error = True)
+                    exit()
             elif opt in ("--dry-run", "-n"):
                 config["dry-run"] = True
             elif opt in ("--debug", "-d"):
                 config["debug"] = True
+            elif opt in ("--force", "-f"):
+                config["force"] = True
+            elif opt in ("--sync", "-y"):
+                config["sync"] = True
+            elif opt in ("--delta", "-D"):
+                config["delta"] = True
+            elif opt in ("--compress", "-z"):
+                config["compress"] = True
+            elif opt in ("--batch", "-b"):
+                config["batch"] = True
+            elif opt in ("--stats", "-S"):
+                config["stats"] = True
+            elif opt in ("--verify", "-V"):
+                config["verify"] = True
+            elif opt in ("--trace", "-T"):
+                config["trace"] = arg
+            elif opt in ("--connections", "-c", "--jobs", "-j"):
+                k = "connections" if opt in ("--connections", "-c") else "jobs"
+                try:
+                    config[k] = int(arg)
+                except ValueError:
+                    log(f"Error in {k} option: " + usage, error = True)
+                    exit()
 
     if not config["host"]:
         log("Hostname required. " + usage, error = True)
@@ -344,35 +2057,59 @@ if __name__ == "__main__":
         log(prefix='%% Excluding files matching: ', msg = ",".join(config["exclude"]))
     if config["process"]:
         log(prefix='%% Processing files matching: ',
-            msg = ",".join([x['pattern']+':'+x['script'] for x in config["process"]]))
+            msg = ",".join([x['pattern'] +
+                            (f" {'|>' if x['stdout'] else '->'} {x['output']}"
+                             if x['output'] else '') +
+                            ':' + x['script'] for x in config["process"]]))
     if config["up-delete"]:
         log(prefix='%% Deleting uploaded files matching: ', msg = ",".join(config["up-delete"]))
     if config["remote-command"]:
-        pref = '%% Running remote command after upload'
+        pref = '%% Running remote command after uploads'
         if config["remote-match"]:
            pref += " of files matching: "
            pref += _GREEN + ",".join(config["remote-match"]) + _RST
         log(prefix=pref + ': \n', msg = '\t' + config["remote-command"].replace('\0','\n\t'))
             
+    if len(config["host"]) > 1:
+        log(prefix='%% Uploading to hosts: ', msg = ",".join(config["host"]))
+    if config["connections"] > 1:
+        log(prefix='%% Parallel upload sessions: ', msg = str(config["connections"]))
+    if config["trace"]:
+        tracer.open(config["trace"])
+        log(prefix='%% Tracing stage timings to: ', msg = config["trace"])
     log(prefix = '\n== Connecting to FTP...\n')
     try:
-        ftp_handler = FTPWatcher(config, ignore_directories = True, case_sensitive = True)
-        observer = Observer()
-        observer.schedule(ftp_handler, '.', recursive=True)
+        ftp_handler = FTPWatcher(config)
+        if config["poll"] > 0:
+            observer = Poller(ftp_handler, config["poll"], max(config["poll-cpu"], 1))
+            log(prefix = '%% Watching: ', msg = f"{len(observer.dirs)} directories, "
+                f"{observer.files()} files (polling every {config['poll']}s)")
+        else:
+            observer = (pruned_observer(ftp_handler.rules.excluded_dir)
+                        if pruned_observer else Observer())
+            ndirs = ftp_handler.watch(observer)
+            log(prefix = '%% Watching: ', msg = f"{ndirs} directories ({len(ftp_handler.watches)} "
+                f"watch{'es' if len(ftp_handler.watches) > 1 else ''})")
         observer.start()
+        ftp_handler.start()
         while observer.is_alive():
-            observer.join(30)
-            if not ftp_handler.is_ok():
-                log(prefix = f"== {cur_time()} ",
-                    msg = "FTP connection problem, attempting restart...", error = True)
-                ftp_handler.ftp_start()
+            observer.join(1)
     except (KeyboardInterrupt, SystemExit):
         pass
     finally:
         log(prefix = "\nQuitting AutoFTP...\n")
         try:
-            if ftp_handler and ftp_handler.ftp:
-                ftp_handler.ftp.quit()
+            ftp_handler.summary()
+            if config["stats"]:
+                tracer.summary()
+        except NameError:
+            pass
+        try:
+            if ftp_handler:
+                for uploader in ftp_handler.uploaders:
+                    uploader.manifest.flush()
+                    for session in uploader.sessions:
+                        session.quit()
             if observer:
                 observer.stop()
                 observer.join()
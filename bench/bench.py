@@ -0,0 +1,217 @@
+"""Benchmark autoftp against a local uftpd stand-in.
+
+Runs autoftp (with any options given after `--') against bench/standin.py
+over an emulated network, replays standard scenarios, and prints the
+latency from saving a file to its complete arrival on the "device"
+(p50/p95), and files/s, as JSON:
+
+    python bench/bench.py --rtt 20 --bandwidth 200 -- -z -b
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from standin import StandIn, Link, _UFTPD
+
+_AUTOFTP = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "autoftp.py")
+_POLL = 0.002 # seconds between checks for arrived files
+_TIMEOUT = 120. # most seconds to wait for a scenario's files
+
+def source(size, rng):
+    # Python-like text of about size bytes
+    lines = []
+    while size > 0:
+        line = f"value_{rng.randrange(10**6)} = compute({rng.random():.6f}, 'x' * {len(lines)})\n"
+        lines.append(line)
+        size -= len(line)
+    return ''.join(lines)
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.local = tempfile.mkdtemp(prefix = "autoftp-local-")
+        self.remote = tempfile.mkdtemp(prefix = "autoftp-remote-")
+        self.server = StandIn(self.remote, args.port,
+                              Link(args.rtt / 1000, args.bandwidth * 1024, args.loss / 100,
+                                   seed = args.seed),
+                              args.server)
+        self.server.start()
+        self.output = []
+        self.connected = threading.Event()
+
+    def start_autoftp(self):
+        # Run autoftp in the local directory, with ftplib aimed at our port
+        code = (f"import ftplib, runpy, sys; ftplib.FTP.port = {self.args.port}; "
+                f"sys.argv = {[_AUTOFTP, '127.0.0.1'] + self.args.autoftp!r}; "
+                f"runpy.run_path(sys.argv[0], run_name = '__main__')")
+        self.proc = subprocess.Popen((sys.executable, "-u", "-c", code), cwd = self.local,
+                                     stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+                                     text = True)
+        threading.Thread(target = self.read_output, daemon = True).start()
+        if not self.connected.wait(30):
+            raise RuntimeError("autoftp did not connect:\n" + ''.join(self.output))
+        time.sleep(0.5) # observer running
+
+    def read_output(self):
+        for line in self.proc.stdout:
+            self.output.append(line)
+            if "FTP server connected" in line:
+                self.connected.set()
+
+    def stop_autoftp(self):
+        self.proc.send_signal(signal.SIGINT)
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+    def write(self, files):
+        # Write {path: text} locally, returning the time
+        t0 = time.perf_counter()
+        for path, text in files.items():
+            full = os.path.join(self.local, path)
+            os.makedirs(os.path.dirname(full), exist_ok = True)
+            with open(full, "w") as f:
+                f.write(text)
+        return t0
+
+    def arrivals(self, files, t0, during = None):
+        # Wait for files to arrive intact on the remote.  Returns the latency
+        # of each arrived file.  during(n) is called with the number arrived.
+        waiting = {path: text.encode() for path, text in files.items()}
+        latencies = []
+        end = time.perf_counter() + _TIMEOUT
+        while waiting and time.perf_counter() < end:
+            for path, data in list(waiting.items()):
+                full = os.path.join(self.remote, path)
+                try:
+                    if os.path.getsize(full) != len(data): continue
+                    with open(full, "rb") as f:
+                        if f.read() != data: continue
+                except OSError:
+                    continue
+                latencies.append(time.perf_counter() - t0)
+                del waiting[path]
+            if during:
+                during(len(latencies))
+            time.sleep(_POLL)
+        return latencies
+
+    def edits(self, path, size):
+        # Repeatedly edit one line of a file of about size bytes
+        text = source(size, self.rng)
+        self.arrivals({path: text}, self.write({path: text}))
+        latencies = []
+        for i in range(self.args.repeat):
+            lines = text.splitlines(keepends = True)
+            lines[self.rng.randrange(len(lines))] = f"edit_{i} = {self.rng.random()}\n"
+            text = ''.join(lines)
+            latencies += self.arrivals({path: text}, self.write({path: text}))
+        return latencies, self.args.repeat
+
+    def burst(self, prefix, during = None):
+        # Write a tree of 200 files at once, like a branch switch
+        files = {os.path.join(prefix, f"pkg{i // 20}", f"mod{i % 20}.py"):
+                 source(self.rng.randrange(500, 4000), self.rng) for i in range(200)}
+        return self.arrivals(files, self.write(files), during), len(files)
+
+    def small_edit(self):
+        return self.edits("small.py", 300)
+
+    def module_25k(self):
+        return self.edits("module.py", 25 * 1024)
+
+    def branch_switch(self):
+        return self.burst("switch")
+
+    def cut_mid_upload(self):
+        # A 256KB file, its connection cut halfway through its upload, which
+        # must then resume rather than start over
+        files = {"large.py": source(256 * 1024, self.rng)}
+        self.server.cut_after(128 * 1024, self.args.downtime)
+        received = self.server.data_received
+        latencies = self.arrivals(files, self.write(files))
+        received = self.server.data_received - received
+        if self.server.cut: # not cut, e.g. sent compressed to under 128KB
+            self.server.cut = None
+        elif latencies and received >= 1.5 * len(files["large.py"]):
+            raise RuntimeError(f"upload cut off was not resumed ({received} bytes sent):\n" +
+                               ''.join(self.output))
+        return latencies, len(files)
+
+    def reset_mid_burst(self):
+        reset = []
+        def during(arrived):
+            if arrived >= 50 and not reset:
+                reset.append(arrived)
+                self.server.reset(self.args.downtime)
+        return self.burst("reset", during)
+
+    scenarios = {"small-edit": small_edit, "module-25k": module_25k,
+                 "branch-switch": branch_switch, "reset-mid-burst": reset_mid_burst,
+                 "cut-mid-upload": cut_mid_upload}
+
+    def run(self, name):
+        t0 = time.perf_counter()
+        latencies, expected = self.scenarios[name](self)
+        elapsed = time.perf_counter() - t0
+        result = {"scenario": name, "files": expected, "arrived": len(latencies),
+                  "elapsed": round(elapsed, 3)}
+        if latencies:
+            q = statistics.quantiles(latencies, n = 20, method = "inclusive") \
+                if len(latencies) > 1 else latencies * 19
+            result.update(p50 = round(q[9], 4), p95 = round(q[18], 4),
+                          files_per_s = round(len(latencies) / max(latencies), 2))
+        return result
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0],
+                                     usage = "%(prog)s [options] [-- autoftp options]")
+    parser.add_argument("--rtt", type = float, default = 20., help = "round trip time, ms")
+    parser.add_argument("--bandwidth", type = float, default = 200.,
+                        help = "KB/s, 0 for unlimited (default: 200)")
+    parser.add_argument("--loss", type = float, default = 0., help = "packet loss, %%")
+    parser.add_argument("--scenario", action = "append", choices = list(Bench.scenarios),
+                        help = "scenario to run (can repeat; default: all)")
+    parser.add_argument("--repeat", type = int, default = 20, help = "edits per edit scenario")
+    parser.add_argument("--downtime", type = float, default = 1.,
+                        help = "seconds the device is down after a reset")
+    parser.add_argument("--port", type = int, default = 2121)
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--server", default = _UFTPD, help = "uftpd.py to run")
+    parser.add_argument("--log", action = "store_true", help = "show autoftp's output")
+    argv = sys.argv[1:]
+    split = argv.index("--") if "--" in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    args.autoftp = argv[split + 1:]
+
+    bench = Bench(args)
+    results = []
+    try:
+        bench.start_autoftp()
+        for name in args.scenario or Bench.scenarios:
+            results.append(bench.run(name))
+            print(f"{name}: {results[-1]}", file = sys.stderr)
+    finally:
+        bench.stop_autoftp()
+        bench.server.close()
+        shutil.rmtree(bench.local, ignore_errors = True)
+        shutil.rmtree(bench.remote, ignore_errors = True)
+        if args.log:
+            print(''.join(bench.output), file = sys.stderr)
+    json.dump({"rtt_ms": args.rtt, "bandwidth_kbs": args.bandwidth, "loss_pct": args.loss,
+               "autoftp": args.autoftp, "results": results}, sys.stdout, indent = 1)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Microbenchmark autoftp's compiled pattern rules on a synthetic tree.
+
+Classifies every path of a synthetic tree (100k paths by default) against
+a typical set of include, exclude, process, up-delete and remote-match
+patterns, both with Rules and by matching each pattern with PurePath.match
+(as autoftp did before), checks that the two agree, and prints the times
+as JSON:
+
+    python bench/rules.py --paths 100000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from pathlib import PurePath
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from autoftp import Rules
+
+_CONFIG = {"include": ["*.py", "*.mpy", "*.json", "www/*.html"],
+           "exclude": ["*.git/*", "*__pycache__/*", "*build/*", "*dist/*", "*.venv/*",
+                       "*node_modules/*", "secret*.py", "*_test.py", "test_*.py",
+                       "*/tests/*", "*.tmp", "*~", "*.swp", "*.bak", "*.orig",
+                       "*docs/*", "*examples/*", "*vendor/*", "*third_party/*",
+                       "*.autoftp-cache*", "*.autoftp-cache.d/*", "*fixtures/*",
+                       "*old/*", "*archive/*", "*scratch/*", "*.log", "*.lock",
+                       "*[Bb]ackup*/*", "*.ipynb_checkpoints/*", "*.mypy_cache/*"],
+           "process": [{"pattern": "*.py", "script": "mpy-cross"},
+                       {"pattern": "*.scss", "script": "sass"}],
+           "up-delete": ["*.mpy"],
+           "remote-match": ["main.py", "*app/*.py"]}
+
+_DIRS = ["lib", "app", "drivers", "net", "ui", "www", "tests", "build", "docs",
+         "vendor", "util", "sensors", "old", "__pycache__", "backup", "core"]
+_FILES = ["main", "boot", "config", "wifi", "sensor", "display", "secret_keys",
+          "util", "helpers", "widget_test", "test_io", "index", "styles", "data"]
+_EXTS = [".py", ".py", ".py", ".mpy", ".json", ".html", ".scss", ".txt", ".tmp",
+         ".swp", ".log", ".c", ".h", ""]
+
+def tree(n, rng):
+    # n distinct relative paths, 1-7 directories deep
+    paths = set()
+    while len(paths) < n:
+        dirs = [rng.choice(_DIRS) + (str(rng.randrange(5)) if rng.random() < .5 else '')
+                for _ in range(rng.randrange(1, 8))]
+        name = rng.choice(_FILES) + str(rng.randrange(100)) + rng.choice(_EXTS)
+        paths.add(os.path.join(*dirs, name))
+    return sorted(paths)
+
+def path_matches(path, patterns, key = None):
+    # The previous matcher: a Path per call, and PurePath.match per pattern
+    ppath = PurePath(path)
+    return next((x for x in patterns if ppath.match(x[key] if key else x)), None)
+
+def classify(path):
+    return (bool(path_matches(path, _CONFIG["include"])),
+            bool(path_matches(path, _CONFIG["exclude"])),
+            path_matches(path, _CONFIG["process"], key = "pattern"),
+            bool(path_matches(path, _CONFIG["up-delete"])),
+            bool(path_matches(path, _CONFIG["remote-match"])))
+
+def timed(fn, paths):
+    t0 = time.perf_counter()
+    results = [fn(path) for path in paths]
+    return time.perf_counter() - t0, results
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--paths", type = int, default = 100000)
+    parser.add_argument("--seed", type = int, default = 1)
+    args = parser.parse_args()
+    paths = tree(args.paths, random.Random(args.seed))
+    rules = Rules(_CONFIG, _CONFIG["exclude"])
+    t_old, old = timed(classify, paths)
+    t_new, new = timed(rules.classify, paths)
+    t_memo, memo = timed(rules.classify, paths[-2**16:]) # still memoized
+    mismatches = [p for p, a, b in zip(paths, old, new) if a != tuple(b)]
+    for path in mismatches[:10]:
+        print(f"mismatch: {path}", file = sys.stderr)
+    n_memo = min(len(paths), 2**16)
+    json.dump({"paths": len(paths),
+               "purepath_us": round(t_old / len(paths) * 1e6, 3),
+               "rules_us": round(t_new / len(paths) * 1e6, 3),
+               "rules_memoized_us": round(t_memo / n_memo * 1e6, 3),
+               "speedup": round(t_old / t_new, 1),
+               "mismatches": len(mismatches)}, sys.stdout, indent = 1)
+    print()
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
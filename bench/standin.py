@@ -0,0 +1,297 @@
+"""Run example/lib/uftpd.py under CPython, as a stand-in for a device.
+
+The MicroPython modules uftpd uses (socket handler registration, network,
+uos, deflate...) are provided by small shims, with files served from a
+local directory.  Traffic passes through a Link, which delays it to
+emulate a (WiFi) network with a given round trip time, bandwidth and
+packet loss.  Like the device, the server handles one command at a time.
+
+gc.mem_free() reports an emulated heap, from which every bytes object
+returned by socket and file reads is allocated, until gc.collect().
+This tracks the garbage uftpd's data path leaves, as on the device.
+"""
+import os
+import random
+import selectors
+import socket as _socket
+import threading
+import time
+import types
+import zlib
+import builtins
+import errno
+
+_SO_REGISTER_HANDLER = 20
+_UFTPD = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      os.pardir, "example", "lib", "uftpd.py")
+_SEGMENT = 1460 # bytes per TCP segment
+_MIN_RTO = 0.2 # seconds to retransmit a lost segment, at least
+_HEAP = 100 * 1024 # bytes of emulated heap, as on an ESP32
+
+class Link:
+    """Delays for traffic over an emulated network: half the round trip
+    time per message, plus transmission time at the given bandwidth
+    (bytes/s, 0 for unlimited).  Each segment is lost with probability
+    loss, costing a retransmission timeout."""
+    def __init__(self, rtt = 0., bandwidth = 0, loss = 0., seed = None):
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.random = random.Random(seed)
+
+    def delay(self, nbytes, trip = True):
+        d = self.rtt / 2 if trip else 0.
+        if self.bandwidth:
+            d += nbytes / self.bandwidth
+        if self.loss:
+            segments = max(1, -(-nbytes // _SEGMENT))
+            lost = sum(self.random.random() < self.loss for _ in range(segments))
+            d += lost * max(_MIN_RTO, 2 * self.rtt)
+        return d
+
+    def wait(self, nbytes, trip = True):
+        d = self.delay(nbytes, trip)
+        if d > 0:
+            time.sleep(d)
+
+class StandIn:
+    """uftpd serving root on 127.0.0.1:port (with data connections on
+    port + 1), its traffic passing through link."""
+    def __init__(self, root, port = 2121, link = None, src = _UFTPD):
+        self.root = os.path.abspath(root)
+        self.port = port
+        self.link = link or Link()
+        self.src = src
+        self.selector = selectors.DefaultSelector()
+        self.handlers = {} # socket -> (handler, wrapped socket)
+        self.lock = threading.RLock()
+        self.ns = None
+        self.running = True
+        self.garbage = 0 # bytes allocated on the emulated heap since gc.collect()
+        self.cut = None # (bytes, downtime) for cut_after
+        self.data_received = 0 # bytes received on data connections
+        threading.Thread(target = self.dispatch, daemon = True).start()
+
+    def start(self):
+        # Load (as on boot) and start uftpd
+        with self.lock:
+            if self.ns:
+                self.ns["start"](splash = False)
+            else:
+                self.ns = self.load()
+
+    def stop(self):
+        with self.lock:
+            if self.ns:
+                self.ns["stop"]()
+
+    def reset(self, downtime = 1.):
+        # Emulate a device reset: drop all connections, and start again
+        # after downtime (in the background)
+        self.stop()
+        timer = threading.Timer(downtime, self.start)
+        timer.daemon = True
+        timer.start()
+
+    def cut_after(self, nbytes, downtime = 1.):
+        # Emulate the connection dropping (WiFi out of range, say) once the
+        # next upload has received nbytes, and the device returning after
+        # downtime.  The partial file is kept, as on flash.
+        self.cut = (nbytes, downtime)
+
+    def received(self, sock, n):
+        # Note n bytes received on a data connection: cut it as requested
+        self.data_received += n
+        if self.cut and n:
+            left, downtime = self.cut
+            if n < left:
+                self.cut = (left - n, downtime)
+            else:
+                self.cut = None
+                sock.close()
+                self.reset(downtime)
+                raise OSError(errno.ECONNRESET, "connection cut")
+
+    def close(self):
+        self.running = False
+        self.stop()
+
+    def dispatch(self):
+        # uftpd's handlers are called from here, one at a time
+        while self.running:
+            for key, events in self.selector.select(0.1):
+                with self.lock:
+                    handler = self.handlers.get(key.fileobj)
+                    if handler:
+                        try:
+                            handler[0](handler[1])
+                        except OSError:
+                            pass
+
+    def path(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def alloc(self, data):
+        # Note data allocated on the emulated heap
+        self.garbage += len(data)
+        return data
+
+    def mem_free(self):
+        return max(0, _HEAP - self.garbage)
+
+    def load(self):
+        stand_in = self
+        link = self.link
+
+        class Socket:
+            # A MicroPython-like socket, whose traffic is delayed by link
+            def __init__(self, sock, control = False):
+                self.sock = sock
+                self.control = control # else a data connection
+            def setsockopt(self, level, opt, value):
+                if opt != _SO_REGISTER_HANDLER:
+                    return self.sock.setsockopt(level, opt, value)
+                if value is None:
+                    if stand_in.handlers.pop(self.sock, None):
+                        stand_in.selector.unregister(self.sock)
+                else:
+                    stand_in.handlers[self.sock] = (value, self)
+                    stand_in.selector.register(self.sock, selectors.EVENT_READ)
+            def bind(self, addr):
+                port = stand_in.port if addr[1] == 21 else addr[1]
+                self.control = port == stand_in.port
+                self.sock.bind(("127.0.0.1", port))
+            def accept(self):
+                sock, addr = self.sock.accept()
+                time.sleep(link.rtt) # connection setup
+                return Socket(sock, self.control), addr
+            def readline(self):
+                line = b''
+                while not line.endswith(b'\n'):
+                    c = self.sock.recv(1)
+                    if not c: break
+                    line += c
+                link.wait(len(line))
+                return stand_in.alloc(line)
+            def recv(self, n):
+                data = self.sock.recv(n)
+                link.wait(len(data), trip = False)
+                if not self.control:
+                    stand_in.received(self.sock, len(data))
+                return stand_in.alloc(data)
+            def readinto(self, buf, n = 0):
+                n = self.sock.recv_into(buf, n)
+                link.wait(n, trip = False)
+                if not self.control:
+                    stand_in.received(self.sock, n)
+                return n
+            def sendall(self, data):
+                data = data.encode() if isinstance(data, str) else data
+                link.wait(len(data), trip = self.control)
+                self.sock.sendall(data)
+            def __getattr__(self, name):
+                return getattr(self.sock, name)
+
+        socket = types.SimpleNamespace(
+            socket = lambda *args: Socket(_socket.socket(*args)),
+            AF_INET = _socket.AF_INET, SOCK_STREAM = _socket.SOCK_STREAM,
+            SOL_SOCKET = _socket.SOL_SOCKET, SO_REUSEADDR = _socket.SO_REUSEADDR,
+            getaddrinfo = _socket.getaddrinfo)
+        path = self.path
+        uos = types.SimpleNamespace(
+            stat = lambda p: tuple(os.stat(path(p))),
+            listdir = lambda p: os.listdir(path(p)),
+            ilistdir = lambda p: ((e.name, 0x4000 if e.is_dir() else 0x8000, 0)
+                                  for e in os.scandir(path(p))),
+            remove = lambda p: os.remove(path(p)),
+            rmdir = lambda p: os.rmdir(path(p)),
+            mkdir = lambda p: os.mkdir(path(p)),
+            rename = lambda a, b: os.replace(path(a), path(b)))
+        station = types.SimpleNamespace(active = lambda: True,
+                                        ifconfig = lambda: ("127.0.0.1",) * 4)
+        access_point = types.SimpleNamespace(active = lambda: False)
+        network = types.SimpleNamespace(AP_IF = 0, STA_IF = 1,
+                                        WLAN = lambda i: station if i else access_point)
+
+        class DeflateIO:
+            def __init__(self, stream, format = None, wbits = 0):
+                self.stream = stream
+                self.z = zlib.decompressobj()
+                self.buffer = b''
+            def fill(self, n): # the device inflates within a fixed window
+                while len(self.buffer) < n:
+                    chunk = self.stream.sock.recv(1024)
+                    link.wait(len(chunk), trip = False)
+                    if not chunk:
+                        self.buffer += self.z.flush()
+                        break
+                    self.buffer += self.z.decompress(chunk)
+                data, self.buffer = self.buffer[:n], self.buffer[n:]
+                return data
+            def read(self, n):
+                return stand_in.alloc(self.fill(n))
+            def readinto(self, buf):
+                data = self.fill(len(buf))
+                buf[:len(data)] = data
+                return len(data)
+
+        class File:
+            # A file whose reads allocate on the emulated heap
+            def __init__(self, file):
+                self.file = file
+            def read(self, n = -1):
+                return stand_in.alloc(self.file.read(n))
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                self.file.close()
+            def __getattr__(self, name):
+                return getattr(self.file, name)
+
+        modules = {
+            "socket": socket, "network": network, "uos": uos,
+            "deflate": types.SimpleNamespace(DeflateIO = DeflateIO, ZLIB = 1),
+            "micropython": types.SimpleNamespace(
+                alloc_emergency_exception_buf = lambda n: None),
+            "time": types.SimpleNamespace(sleep_ms = lambda ms: time.sleep(ms / 1000),
+                                          localtime = time.localtime),
+            "gc": types.SimpleNamespace(collect = lambda: setattr(self, "garbage", 0),
+                                        mem_free = self.mem_free)}
+
+        def _import(name, *args, **kwargs):
+            if name in modules:
+                return modules[name]
+            return builtins.__import__(name, *args, **kwargs)
+
+        def _open(p, mode = 'r'): # MicroPython files are bytes-clean
+            return File(open(path(p), mode.replace('b', '') + 'b'))
+
+        ns = {"__builtins__": dict(vars(builtins), __import__ = _import, open = _open,
+                                   print = lambda *args, **kwargs: None),
+              "__name__": "uftpd",
+              "const": lambda value: self.port + 1 if value == 13333 else value} # data port
+        with open(self.src) as f:
+            exec(compile(f.read(), self.src, "exec"), ns) # starts the server
+        return ns
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("root", help = "directory to serve")
+    parser.add_argument("--port", type = int, default = 2121)
+    parser.add_argument("--rtt", type = float, default = 0., help = "round trip time, ms")
+    parser.add_argument("--bandwidth", type = float, default = 0.,
+                        help = "KB/s (default: unlimited)")
+    parser.add_argument("--loss", type = float, default = 0., help = "packet loss, %%")
+    parser.add_argument("--server", default = _UFTPD, help = "uftpd.py to run")
+    args = parser.parse_args()
+    server = StandIn(args.root, args.port,
+                     Link(args.rtt / 1000, args.bandwidth * 1024, args.loss / 100),
+                     args.server)
+    server.start()
+    print(f"uftpd stand-in serving {server.root} on 127.0.0.1:{args.port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.close()
@@ -0,0 +1,107 @@
+"""Benchmark uftpd's file data path on the CPython stand-in.
+
+Stores (STOR, and XDFL if compressible) and retrieves (RETR) a file with
+each given uftpd.py and transfer chunk size, and prints throughput and
+the emulated gc.mem_free() before and after each transfer (see
+standin.py) as JSON.  To compare with an earlier uftpd.py:
+
+    git show HEAD~1:example/lib/uftpd.py > /tmp/uftpd_old.py
+    python bench/uftpd_io.py --server /tmp/uftpd_old.py --server example/lib/uftpd.py
+"""
+import argparse
+import ftplib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+from standin import StandIn, Link, _UFTPD, _HEAP
+
+def transfer(server, ftp, cmd, data):
+    # Run one transfer, returning (seconds, emulated mem_free after it)
+    t0 = time.perf_counter()
+    if cmd == "RETR":
+        out = io.BytesIO()
+        ftp.retrbinary("RETR bench.bin", out.write)
+        if out.getvalue() != data:
+            raise RuntimeError("RETR returned wrong data")
+    else:
+        payload = data if cmd == "STOR" else zlib.compress(data, 9)
+        ftp.storbinary(cmd + " bench.bin", io.BytesIO(payload))
+    return time.perf_counter() - t0, server.mem_free()
+
+def run(args, src, chunk):
+    remote = tempfile.mkdtemp(prefix = "uftpd-io-")
+    server = StandIn(remote, args.port, Link(args.rtt / 1000, args.bandwidth * 1024), src)
+    try:
+        server.start()
+        if chunk:
+            server.ns["restart"](splash = False, chunk_size = chunk)
+        data = bytes(random.Random(args.seed).choice(b"abcdefgh \n")
+                     for _ in range(args.size * 1024))
+        ftp = ftplib.FTP()
+        ftp.connect("127.0.0.1", args.port)
+        ftp.login()
+        cmds = ["STOR", "RETR"]
+        try:
+            feat = ftp.sendcmd("FEAT")
+        except ftplib.error_perm: # no FEAT: no extensions
+            feat = ""
+        if "XDFL" in feat:
+            cmds.append("XDFL")
+        results = []
+        for cmd in cmds:
+            times, free = [], []
+            for _ in range(args.repeat):
+                t, f = transfer(server, ftp, cmd, data)
+                times.append(t)
+                free.append(f)
+            with open(os.path.join(remote, "bench.bin"), "rb") as f:
+                if f.read() != data:
+                    raise RuntimeError(f"{cmd} stored wrong data")
+            results.append({"cmd": cmd,
+                            "mb_per_s": round(len(data) / min(times) / 2**20, 2),
+                            "mem_free_before": _HEAP,
+                            "mem_free_after": min(free)})
+        ftp.quit()
+        return results
+    finally:
+        server.close()
+        shutil.rmtree(remote, ignore_errors = True)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--server", action = "append",
+                        help = "uftpd.py to run (can repeat; default: example/lib/uftpd.py)")
+    parser.add_argument("--chunk", type = int, action = "append",
+                        help = "transfer chunk size, bytes, for servers which take one "
+                        "(can repeat; default: the server's own)")
+    parser.add_argument("--size", type = int, default = 64, help = "file size, KB")
+    parser.add_argument("--repeat", type = int, default = 5, help = "transfers of each kind")
+    parser.add_argument("--rtt", type = float, default = 0., help = "round trip time, ms")
+    parser.add_argument("--bandwidth", type = float, default = 0.,
+                        help = "KB/s (default: unlimited)")
+    parser.add_argument("--port", type = int, default = 2121)
+    parser.add_argument("--seed", type = int, default = 1)
+    args = parser.parse_args()
+
+    results = []
+    for src in args.server or [_UFTPD]:
+        with open(src) as f:
+            tunable = "chunk_size" in f.read()
+        for chunk in (args.chunk or [None]) if tunable else [None]:
+            for result in run(args, src, chunk):
+                result.update(server = src, chunk = chunk)
+                results.append(result)
+                print(f"{os.path.basename(src)} chunk={chunk}: {result}", file = sys.stderr)
+    json.dump({"size_kb": args.size, "heap": _HEAP, "results": results},
+              sys.stdout, indent = 1)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,28 @@ import gc
 import sys
 from time import sleep_ms, localtime
 from micropython import alloc_emergency_exception_buf
+try:
+    from deflate import DeflateIO, ZLIB
+
+    def inflater(stream):
+        return DeflateIO(stream, ZLIB)
+except ImportError:
+    try:
+        from zlib import DecompIO
+
+        def inflater(stream):
+            return DecompIO(stream, _DEFLATE_WBITS)
+    except ImportError:
+        inflater = None
+try:
+    from hashlib import sha256
+    from binascii import hexlify
+except ImportError:
+    try:
+        from uhashlib import sha256
+        from ubinascii import hexlify
+    except ImportError:
+        sha256 = None
 
 # constant definitions
 _CHUNK_SIZE = const(1024)
@@ -32,6 +54,7 @@ _SO_REGISTER_HANDLER = const(20)
 _COMMAND_TIMEOUT = const(300)
 _DATA_TIMEOUT = const(100)
 _DATA_PORT = const(13333)
+_DEFLATE_WBITS = const(10)  # window size used by autoftp --compress
 
 # Global variables
 ftpsockets = []
@@ -39,6 +62,8 @@ datasocket = None
 client_list = []
 verbose_l = 0
 client_busy = False
+chunk = None  # transfer buffer, allocated once by start()
+chunk_view = None
 # Interfaces: (IP-Address (string), IP-Address (integer), Netmask (integer))
 
 _month_name = ("", "Jan", "Feb", "Mar", "Apr", "May", "Jun",
@@ -63,6 +88,7 @@ class FTP_client:
         self.DATA_PORT = 20
         self.active = True
         self.pasv_data_addr = local_addr
+        self.rest = 0  # REST offset for the next transfer
 
     def send_list_data(self, path, data_client, full):
         try:
@@ -103,22 +129,153 @@ class FTP_client:
             description = fname + "\r\n"
         return description
 
-    def send_file_data(self, path, data_client):
-        with open(path, "r") as file:
-            chunk = file.read(_CHUNK_SIZE)
-            while len(chunk) > 0:
-                data_client.sendall(chunk)
-                chunk = file.read(_CHUNK_SIZE)
+    # Data is moved through the preallocated chunk buffer, with readinto,
+    # so transfers don't fill the heap with short-lived chunks
+    def send_file_data(self, path, data_client, rest=0):
+        with open(path, "rb") as file:
+            file.seek(rest)
+            n = file.readinto(chunk)
+            while n:
+                data_client.sendall(filled(n))
+                n = file.readinto(chunk)
             data_client.close()
 
     def save_file_data(self, path, data_client, mode):
         with open(path, mode) as file:
-            chunk = data_client.recv(_CHUNK_SIZE)
-            while len(chunk) > 0:
-                file.write(chunk)
-                chunk = data_client.recv(_CHUNK_SIZE)
+            n = data_client.readinto(chunk)
+            while n:
+                file.write(filled(n))
+                n = data_client.readinto(chunk)
             data_client.close()
 
+    # Inflate a zlib stream sent by autoftp, in bounded memory
+    def inflate_file_data(self, path, data_client):
+        stream = inflater(data_client)
+        with open(path, "wb") as file:
+            n = stream.readinto(chunk)
+            while n:
+                file.write(filled(n))
+                n = stream.readinto(chunk)
+            data_client.close()
+
+    # Copy length bytes from stream to file, through the chunk buffer
+    def copy_data(self, stream, file, length):
+        while length > 0:
+            n = stream.readinto(chunk if length >= len(chunk) else chunk_view[:length])
+            if not n:
+                raise OSError("short copy")
+            file.write(filled(n))
+            length -= n
+
+    # Store a batch of files sent by autoftp: records of path length (2
+    # bytes), path, data length (4 bytes) and data, until the connection
+    # closes.  Directories are created as needed.
+    def save_batch_data(self, data_client):
+        count = 0
+        head = data_client.recv(1)
+        while len(head) > 0:
+            length = int.from_bytes(head + self.recv_exact(data_client, 1), "big")
+            path = self.get_absolute_path(
+                self.cwd, self.recv_exact(data_client, length).decode())
+            self.make_dirs(self.split_path(path)[0])
+            length = self.recv_int(data_client)
+            with open(path, "wb") as file:
+                self.copy_data(data_client, file, length)
+            count += 1
+            head = data_client.recv(1)
+        data_client.close()
+        return count
+
+    # Send a line of "digest size path" (sha256, in hex) for each file in
+    # the tree at path (or just that file), for autoftp --sync and
+    # --verify.  Only the directories still to visit are held in memory.
+    def send_hash_data(self, path, data_client):
+        if uos.stat(path)[0] & 0x4000 == 0:
+            self.send_hash_line(path, self.split_path(path)[1], data_client)
+        else:
+            top = path.rstrip("/") + "/"
+            todo = [""]
+            while todo:
+                rel = todo.pop()
+                for entry in uos.ilistdir(top + rel):
+                    name = rel + entry[0]
+                    if entry[1] & 0x4000:
+                        todo.append(name + "/")
+                    else:
+                        self.send_hash_line(top + name, name, data_client)
+        data_client.close()
+
+    def send_hash_line(self, path, name, data_client):
+        digest, size = self.hash_file(path)
+        data_client.sendall("{} {} {}\r\n".format(
+            hexlify(digest).decode(), size, name))
+
+    def hash_file(self, path):
+        digest = sha256()
+        size = 0
+        with open(path, "rb") as file:
+            n = file.readinto(chunk)
+            while n:
+                digest.update(filled(n))
+                size += n
+                n = file.readinto(chunk)
+        return digest.digest(), size
+
+    def make_dirs(self, path):
+        if path == "/":
+            return
+        try:
+            uos.stat(path)
+        except OSError:
+            self.make_dirs(self.split_path(path)[0])
+            uos.mkdir(path)
+
+    def recv_exact(self, data_client, length):
+        data = b''
+        while len(data) < length:
+            part = data_client.recv(length - len(data))
+            if len(part) == 0:
+                raise OSError("short read")
+            data += part
+        return data
+
+    def recv_int(self, data_client):
+        return int.from_bytes(self.recv_exact(data_client, 4), "big")
+
+    # Apply a patch sent by autoftp: the expected size and sha256 digest
+    # of the current file, then ops 'C' (copy offset, length from the
+    # current file) and 'I' (insert length bytes), written to a temporary
+    # file swapped in.
+    def patch_file_data(self, path, data_client):
+        temp = path + ".xpat"
+        try:
+            size = self.recv_int(data_client)
+            digest = self.recv_exact(data_client, 32)
+            if size != uos.stat(path)[6] or (
+                    sha256 is not None and self.hash_file(path)[0] != digest):
+                raise OSError("base mismatch")
+            with open(path, "rb") as old, open(temp, "wb") as new:
+                op = data_client.recv(1)
+                while len(op) > 0:
+                    if op == b"C":
+                        old.seek(self.recv_int(data_client))
+                        self.copy_data(old, new, self.recv_int(data_client))
+                    elif op == b"I":
+                        self.copy_data(data_client, new,
+                                       self.recv_int(data_client))
+                    else:
+                        raise OSError("bad op")
+                    op = data_client.recv(1)
+            data_client.close()
+            uos.remove(path)
+            uos.rename(temp, path)
+        except:
+            try:
+                uos.remove(temp)
+            except:
+                pass
+            raise
+
     def get_absolute_path(self, cwd, payload):
         # Just a few special cases "..", "." and ""
         # If payload start's with /, set cwd to /
@@ -211,6 +368,8 @@ class FTP_client:
             payload = data[len(command):].lstrip()  # partition is missing
             path = self.get_absolute_path(self.cwd, payload)
             log_msg(1, "Command={}, Payload={}".format(command, payload))
+            rest = self.rest  # applies to this command only
+            self.rest = 0
 
             if command == "USER":
                 # self.logged_in = True
@@ -226,6 +385,16 @@ class FTP_client:
                 cl.sendall("230 Logged in.\r\n")
             elif command == "SYST":
                 cl.sendall("215 UNIX Type: L8\r\n")
+            elif command == "FEAT":
+                cl.sendall("211-Extensions supported:\r\n"
+                           " XBAT\r\n"
+                           " XPAT\r\n"
+                           " REST STREAM\r\n")
+                if inflater is not None:
+                    cl.sendall(" XDFL\r\n")
+                if sha256 is not None:
+                    cl.sendall(" XHSH\r\n")
+                cl.sendall("211 End.\r\n")
             elif command in ("TYPE", "NOOP", "ABOR"):  # just accept & ignore
                 cl.sendall('200 OK\r\n')
             elif command == "QUIT":
@@ -281,7 +450,7 @@ class FTP_client:
                 try:
                     data_client = self.open_dataclient()
                     cl.sendall("150 Opened data connection.\r\n")
-                    self.send_file_data(path, data_client)
+                    self.send_file_data(path, data_client, rest)
                     # if the next statement is reached,
                     # the data_client was closed.
                     data_client = None
@@ -291,11 +460,17 @@ class FTP_client:
                     if data_client is not None:
                         data_client.close()
             elif command == "STOR" or command == "APPE":
+                data_client = None
                 try:
+                    # resume only at the end of the partial file (for
+                    # autoftp), as files can't be truncated
+                    if rest and rest != uos.stat(path)[6]:
+                        raise OSError("bad offset")
                     data_client = self.open_dataclient()
                     cl.sendall("150 Opened data connection.\r\n")
                     self.save_file_data(path, data_client,
-                                        "w" if command == "STOR" else "a")
+                                        "wb" if command == "STOR" and not rest
+                                        else "ab")
                     # if the next statement is reached,
                     # the data_client was closed.
                     data_client = None
@@ -304,6 +479,62 @@ class FTP_client:
                     cl.sendall('550 Fail\r\n')
                     if data_client is not None:
                         data_client.close()
+            elif command == "XBAT":  # store many files, for autoftp --batch
+                data_client = None
+                try:
+                    data_client = self.open_dataclient()
+                    cl.sendall("150 Opened data connection.\r\n")
+                    count = self.save_batch_data(data_client)
+                    data_client = None
+                    cl.sendall("226 Stored {} files.\r\n".format(count))
+                except:
+                    cl.sendall('550 Fail\r\n')
+                    if data_client is not None:
+                        data_client.close()
+            elif command == "XPAT":  # patch a file, for autoftp --delta
+                data_client = None
+                try:
+                    data_client = self.open_dataclient()
+                    cl.sendall("150 Opened data connection.\r\n")
+                    self.patch_file_data(path, data_client)
+                    data_client = None
+                    cl.sendall("226 Done.\r\n")
+                except:
+                    cl.sendall('550 Fail\r\n')
+                    if data_client is not None:
+                        data_client.close()
+            elif command == "XDFL" and inflater is not None:
+                # store compressed, for autoftp --compress
+                data_client = None
+                try:
+                    data_client = self.open_dataclient()
+                    cl.sendall("150 Opened data connection.\r\n")
+                    self.inflate_file_data(path, data_client)
+                    data_client = None
+                    cl.sendall("226 Done.\r\n")
+                except:
+                    cl.sendall('550 Fail\r\n')
+                    if data_client is not None:
+                        data_client.close()
+            elif command == "XHSH" and sha256 is not None:
+                # hash a tree, for autoftp --sync and --verify
+                data_client = None
+                try:
+                    data_client = self.open_dataclient()
+                    cl.sendall("150 Opened data connection.\r\n")
+                    self.send_hash_data(path, data_client)
+                    data_client = None
+                    cl.sendall("226 Done.\r\n")
+                except:
+                    cl.sendall('550 Fail\r\n')
+                    if data_client is not None:
+                        data_client.close()
+            elif command == "REST":  # offset for the next RETR or STOR
+                try:
+                    self.rest = int(payload)
+                    cl.sendall("350 Restarting at {}.\r\n".format(self.rest))
+                except ValueError:
+                    cl.sendall("501 Bad offset.\r\n")
             elif command == "SIZE":
                 try:
                     cl.sendall('213 {}\r\n'.format(uos.stat(path)[6]))
@@ -382,6 +613,11 @@ class FTP_client:
         client_busy = False
 
 
+# The first n bytes read into chunk: a full one needs no slice
+def filled(n):
+    return chunk if n == len(chunk) else chunk_view[:n]
+
+
 def log_msg(level, *args):
     global verbose_l
     if verbose_l >= level:
@@ -439,15 +675,23 @@ def stop():
         datasocket = None
 
 
-# start listening for ftp connections on port 21
-def start(port=21, verbose=0, splash=True):
+# start listening for ftp connections on port 21.  chunk_size is the
+# size of the buffer file data is transferred through: larger is faster,
+# at the cost of RAM.
+def start(port=21, verbose=0, splash=True, chunk_size=_CHUNK_SIZE):
     global ftpsockets, datasocket
     global verbose_l
     global client_list
     global client_busy
+    global chunk, chunk_view
 
     alloc_emergency_exception_buf(100)
     verbose_l = verbose
+    if chunk is None or len(chunk) != chunk_size:
+        chunk = None
+        gc.collect()
+        chunk = bytearray(chunk_size)
+        chunk_view = memoryview(chunk)
     client_list = []
     client_busy = False
 
@@ -475,10 +719,10 @@ def start(port=21, verbose=0, splash=True):
     datasocket.listen(1)
     datasocket.settimeout(10)
 
-def restart(port=21, verbose=0, splash=True):
+def restart(port=21, verbose=0, splash=True, chunk_size=_CHUNK_SIZE):
     stop()
     sleep_ms(200)
-    start(port, verbose, splash)
+    start(port, verbose, splash, chunk_size)
 
 
 start(splash=True) 